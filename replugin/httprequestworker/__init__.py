@@ -17,10 +17,38 @@
 HTTP Request worker.
 """
 
-import base64
-import requests
+import time
 
-from reworker.worker import Worker
+#: When this module started loading. Used to measure startup time, so it
+#: is taken before the remaining imports.
+_LOADED = time.time()
+
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import signal  # noqa: E402
+import urlparse  # noqa: E402
+
+from reworker.worker import Worker  # noqa: E402
+
+from replugin.httprequestworker import events  # noqa: E402
+from replugin.httprequestworker import lanes  # noqa: E402
+from replugin.httprequestworker import profiling  # noqa: E402
+from replugin.httprequestworker import sessions  # noqa: E402
+from replugin.httprequestworker import templates  # noqa: E402
+
+#: State built by preload() before forking, keyed by config section
+_preloaded = {}
+
+#: Seconds between checks for consumers on the lane queues
+LANE_CHECK_INTERVAL = 30
+
+
+def _preload_key(name, section):
+    """
+    Returns the _preloaded key for a config section.
+    """
+    return (name, json.dumps(section, sort_keys=True))
 
 
 class HTTPRequestWorkerError(Exception):
@@ -33,12 +61,84 @@ class HTTPRequestWorkerError(Exception):
 class HTTPRequestWorker(Worker):
     """
     Worker which provides HTTP Request functionality.
+
+    *Optional Config Keys*:
+        * templates: named request templates. See
+          replugin.httprequestworker.templates.
+        * hosts: per-host profiles with default headers, auth, TLS
+          verification and proxies. See replugin.httprequestworker.sessions.
+        * stats_interval: log worker stats every N messages (default 100,
+          0 disables).
+        * prewarm: list of URLs to open pooled connections to before
+          consuming. Without it the transport is built on first use.
+        * lanes: priority lanes messages are forwarded to. See
+          replugin.httprequestworker.lanes.
+        * logging: event sample rates and async log output. See
+          replugin.httprequestworker.events.
+        * profiling: sampled per-message cProfile and allocation tracing.
+          See replugin.httprequestworker.profiling.
+        * concurrency: adaptive per-host concurrency limit settings. See
+          replugin.httprequestworker.concurrency.
+        * hedging: delay percentile and budget for hedged Get requests.
+          See replugin.httprequestworker.hedging.
+        * file_root: directory local files named by messages must be in.
+          Without it messages may not name local files.
     """
 
     #: allowed subcommands
-    subcommands = ('Get', 'Delete', 'Put', 'Post')
+    subcommands = ('Get', 'Delete', 'Put', 'Post', 'Download')
     dynamic = []
 
+    def __init__(self, *args, **kwargs):
+        Worker.__init__(self, *args, **kwargs)
+        # Compile once so each message only needs variable substitution
+        section = self._config.get('templates', {})
+        self._templates = _preloaded.get(_preload_key('templates', section))
+        if self._templates is None:
+            self._templates = templates.compile_templates(section)
+        # Built on first use unless preloaded so requests is not imported
+        # at startup. Profiles are still checked now so bad config fails
+        # here rather than on a message.
+        section = self._config.get('hosts', {})
+        self._sessions = _preloaded.get(_preload_key('hosts', section))
+        if self._sessions is None:
+            for host, profile in section.items():
+                try:
+                    sessions.check_profile(host, profile)
+                except ValueError, ve:
+                    raise HTTPRequestWorkerError(
+                        'Invalid hosts config: %s' % ve)
+        self._concurrency = None
+        self._hedging = None
+        self._in_flight = False
+        self._draining = False
+        log_config = self._config.get('logging', {})
+        self._events = events.EventLogger(
+            self.app_logger, log_config.get('sample_rates'))
+        if log_config.get('async', False):
+            events.make_async(self.app_logger, log_config.get('buffer', 10000))
+        self._profiler = profiling.MessageProfiler(
+            logger=self.app_logger, **self._config.get('profiling', {}))
+        self._lanes = lanes.load_lanes(
+            self._config.get('lanes', []), self._queue)
+        self._lane = None
+        # Consumers per lane queue, filled in when the queues are declared
+        self._lane_consumers = {}
+        self._lanes_checked = None
+        lane_name = os.environ.get(lanes.LANE_ENV)
+        if lane_name:
+            for lane in self._lanes:
+                if lane.name == lane_name:
+                    self._lane = lane
+                    self._queue = lane.queue
+                    break
+            else:
+                raise HTTPRequestWorkerError('Unknown lane %s' % lane_name)
+        self._prewarm = self._config.get('prewarm', [])
+        self._startup_seconds = None
+        self._stats_interval = int(self._config.get('stats_interval', 100))
+        self._processed = 0
+
     # Subcommand methods
     def request_get(self, body, corr_id, output):
         """
@@ -54,15 +154,9 @@ class HTTPRequestWorker(Worker):
         params = body.get('parameters', {})
 
         try:
-            url = params['url']
-            response = requests.get(url)
+            response = self._send('get', params)
             self._check_code(response.status_code, params)
             return 'Get to URL returned %s as expected.' % response.status_code
-        except requests.ConnectionError, ce:
-            self.app_logger.warn(
-                'Unable to connect to URL %s. Error: %s' % (url, ce))
-            raise HTTPRequestWorkerError(
-                'Could not connect to the requested URL.')
         except KeyError, ke:
             raise HTTPRequestWorkerError(
                 'Missing input %s' % ke)
@@ -81,16 +175,10 @@ class HTTPRequestWorker(Worker):
         params = body.get('parameters', {})
 
         try:
-            url = params['url']
-            response = requests.delete(url)
+            response = self._send('delete', params)
             self._check_code(response.status_code, params)
             return 'Delete to URL returned %s as expected.' % (
                 response.status_code)
-        except requests.ConnectionError, ce:
-            self.app_logger.warn(
-                'Unable to connect to URL %s. Error: %s' % (url, ce))
-            raise HTTPRequestWorkerError(
-                'Could not connect to the requested URL.')
         except KeyError, ke:
             raise HTTPRequestWorkerError(
                 'Missing input %s' % ke)
@@ -109,23 +197,17 @@ class HTTPRequestWorker(Worker):
         params = body.get('parameters', {})
 
         try:
-            url = params['url']
             content_type = params['contenttype']
-            content = params['content']
-
-            if params.get('b64encoded', False):
-                content = base64.decodestring(params['content'])
-
-            headers = {'content-type': content_type}
-            response = requests.put(url, data=content, headers=headers)
+            # false or null ask for a normal request
+            if params.get('chunked') not in (None, False):
+                response = self._chunked_upload(params)
+            else:
+                response = self._send(
+                    'put', params, content_type=content_type,
+                    data=self._content(params))
 
             self._check_code(response.status_code, params)
             return 'Put to URL returned %s as expected.' % response.status_code
-        except requests.ConnectionError, ce:
-            self.app_logger.warn(
-                'Unable to connect to URL %s. Error: %s' % (url, ce))
-            raise HTTPRequestWorkerError(
-                'Could not connect to the requested URL.')
         except KeyError, ke:
             raise HTTPRequestWorkerError(
                 'Missing input %s' % ke)
@@ -144,27 +226,340 @@ class HTTPRequestWorker(Worker):
         params = body.get('parameters', {})
 
         try:
-            url = params['url']
             content_type = params['contenttype']
-            content = params['content']
-
-            if params.get('b64encoded', False):
-                content = base64.decodestring(params['content'])
-
-            headers = {'content-type': content_type}
-            response = requests.post(url, data=content, headers=headers)
+            # false or null ask for a normal request
+            if params.get('chunked') not in (None, False):
+                response = self._chunked_upload(params)
+            else:
+                response = self._send(
+                    'post', params, content_type=content_type,
+                    data=self._content(params))
             self._check_code(response.status_code, params)
             return 'Post to URL returned %s as expected.' % (
                 response.status_code)
-        except requests.ConnectionError, ce:
-            self.app_logger.warn(
-                'Unable to connect to URL %s. Error: %s' % (url, ce))
+        except KeyError, ke:
             raise HTTPRequestWorkerError(
-                'Could not connect to the requested URL.')
+                'Missing input %s' % ke)
+
+    def request_download(self, body, corr_id, output):
+        """
+        Executes an HTTP GET request and writes the response to a file.
+        See replugin.httprequestworker.downloads.
+
+        Parameters:
+
+        * body: The message body structure
+        * corr_id: The correlation id of the message
+        * output: The output object back to the user
+        """
+        import requests
+        from replugin.httprequestworker import downloads
+
+        # Get needed variables
+        params = body.get('parameters', {})
+
+        try:
+            url = params['url']
+            path = self._local_path(params, 'path')
+            checksum = params.get('checksum')
+            if checksum is not None:
+                # Fail before anything is fetched or written
+                downloads.parse_checksum(checksum)
+            downloader = downloads.Downloader(
+                self._session_for(url),
+                url,
+                path,
+                headers=self._headers(params),
+                segment_size=self._positive_int(
+                    params, 'segment_size', 8 * 1024 * 1024),
+                parallel=self._positive_int(params, 'parallel', 4),
+                retries=self._positive_int(params, 'retries', 3))
+
+            response = self._send('get', params, stream=True)
+            try:
+                self._check_code(response.status_code, params)
+            except HTTPRequestWorkerError:
+                response.close()
+                raise
+            size = downloader.fetch(response, checksum)
+            return (
+                'Download of URL returned %s as expected. %s bytes written '
+                'to %s.' % (response.status_code, size, path))
+        except (downloads.DownloadError, requests.RequestException,
+                IOError, OSError), de:
+            self.app_logger.warn('Download of %s failed: %s', url, de)
+            raise HTTPRequestWorkerError('Download failed: %s' % de)
         except KeyError, ke:
             raise HTTPRequestWorkerError(
                 'Missing input %s' % ke)
 
+    def _content(self, params):
+        """
+        Returns the request body given in the message.
+
+        Parameters:
+        * params: The parameters passed into the the subcommand method
+        """
+        content = params['content']
+        if params.get('b64encoded', False):
+            import base64
+            content = base64.decodestring(content)
+        return content
+
+    def _chunked_upload(self, params):
+        """
+        Uploads the body in parts as set by the chunked parameter and
+        returns the final response.
+
+        Parameters:
+        * params: The parameters passed into the the subcommand method
+        """
+        import requests
+        from replugin.httprequestworker import uploads
+
+        options = params['chunked']
+        # true asks for the defaults
+        if options is True:
+            options = {}
+        elif not isinstance(options, dict):
+            raise HTTPRequestWorkerError(
+                'chunked must be true or an object of options')
+        url = params['url']
+        part_size = self._positive_int(
+            options, 'part_size', 8 * 1024 * 1024)
+        parallel = self._positive_int(options, 'parallel', 4)
+        retries = self._positive_int(options, 'retries', 3)
+        try:
+            if 'file' in params:
+                source = uploads.PartSource(
+                    path=self._local_path(params, 'file'))
+            else:
+                source = uploads.PartSource(content=self._content(params))
+        except (IOError, OSError), ioe:
+            raise HTTPRequestWorkerError(
+                'Unable to read upload source: %s' % ioe)
+
+        uploader = uploads.ChunkedUploader(
+            self._session_for(url),
+            url,
+            source,
+            params['contenttype'],
+            headers=self._headers(params),
+            part_size=part_size,
+            parallel=parallel,
+            retries=retries)
+        protocol = options.get('protocol', 's3')
+        try:
+            if protocol == 's3':
+                return uploader.upload_s3(options.get('upload_id'))
+            elif protocol == 'content-range':
+                return uploader.upload_content_range(
+                    options.get('resume', False))
+        except (uploads.UploadError, requests.RequestException), ue:
+            message = 'Chunked upload failed: %s' % ue
+            if uploader.upload_id is not None:
+                message += '. Resume with upload_id %s' % uploader.upload_id
+            self.app_logger.warn('Upload to %s: %s', url, message)
+            raise HTTPRequestWorkerError(message)
+        raise HTTPRequestWorkerError(
+            'Unknown chunked upload protocol %s' % protocol)
+
+    def _local_path(self, params, key):
+        """
+        Returns the real path of a local file named by a message. Relative
+        paths are taken from file_root and the result must be inside it.
+
+        Parameters:
+        * params: The parameters passed into the the subcommand method
+        * key: The parameter holding the path
+        """
+        root = self._config.get('file_root')
+        if not root:
+            raise HTTPRequestWorkerError(
+                '%s is not allowed unless file_root is configured' % key)
+        if not isinstance(params[key], basestring):
+            raise HTTPRequestWorkerError('%s must be a string' % key)
+        root = os.path.realpath(root)
+        path = os.path.realpath(os.path.join(root, params[key]))
+        if not path.startswith(root.rstrip(os.sep) + os.sep):
+            raise HTTPRequestWorkerError(
+                '%s must be inside %s, not %s' % (key, root, params[key]))
+        return path
+
+    def _positive_int(self, options, key, default):
+        """
+        Returns an option which must be a positive integer.
+
+        Parameters:
+        * options: The dictionary holding the option
+        * key: The option name
+        * default: The value to use when the option is not given
+        """
+        value = options.get(key, default)
+        if isinstance(value, bool) or not isinstance(
+                value, (int, long)) or value < 1:
+            raise HTTPRequestWorkerError(
+                '%s must be a positive integer, not %r' % (key, value))
+        return value
+
+    def _session_pool(self):
+        """
+        Returns the session pool, building it on first use. Profiles are
+        resolved once and kept on the pooled sessions.
+        """
+        if self._sessions is None:
+            try:
+                self._sessions = sessions.SessionPool(
+                    self._config.get('hosts', {}))
+            except Exception, ex:
+                self.app_logger.error(
+                    'Unable to build sessions from the hosts config: %s', ex)
+                raise HTTPRequestWorkerError(
+                    'Unable to build sessions from the hosts config: %s' % ex)
+        return self._sessions
+
+    def _session_for(self, url):
+        """
+        Returns the pooled session for url, held to the adaptive
+        concurrency limit of its host.
+
+        Parameters:
+        * url: The URL about to be requested
+        """
+        if self._concurrency is None:
+            from replugin.httprequestworker import concurrency
+            self._concurrency = concurrency.ConcurrencyController(
+                **self._config.get('concurrency', {}))
+        return self._concurrency.wrap(
+            urlparse.urlsplit(url).netloc,
+            self._session_pool().session_for(url))
+
+    def _hedger(self):
+        """
+        Returns the hedger for Get requests, creating it on first use.
+        """
+        if self._hedging is None:
+            from replugin.httprequestworker import hedging
+            self._hedging = hedging.Hedger(**self._config.get('hedging', {}))
+        return self._hedging
+
+    def _send(self, method, params, content_type=None, **kwargs):
+        """
+        Sends a request using the pooled session for the URL's host.
+        Get requests with the hedge parameter set are hedged.
+
+        Parameters:
+        * method: The lower case HTTP method name
+        * params: The parameters passed into the the subcommand method
+        * content_type: The content-type of the request body, if any
+        * kwargs: Extra keyword arguments for the session method
+        """
+        import requests
+
+        url = params['url']
+        host = urlparse.urlsplit(url).netloc
+        headers = self._headers(params, content_type)
+
+        # The second attempt of a hedged request only goes out if this
+        # session can reserve a slot for it without waiting
+        hedge_session = None
+
+        def attempt(number):
+            started = time.time()
+            session = hedge_session
+            if number == 1 or session is None:
+                session = self._session_for(url)
+            try:
+                response = getattr(session, method)(
+                    url, headers=headers, **kwargs)
+            except requests.ConnectionError, ce:
+                self._events.event(
+                    'http.connection_error', logging.WARNING, host=host,
+                    method=method.upper(), attempt=number, error=ce)
+                raise
+            self._events.event(
+                'http.response', host=host, method=method.upper(),
+                attempt=number, status=response.status_code,
+                duration_ms=int((time.time() - started) * 1000))
+            return response
+
+        try:
+            if method == 'get' and params.get('hedge', False):
+                hedge_session = self._session_for(url)
+                return self._hedger().send(
+                    host, attempt, hedge_session.reserve)
+            return attempt(1)
+        except requests.ConnectionError:
+            raise HTTPRequestWorkerError(
+                'Could not connect to the requested URL.')
+
+    def _headers(self, params, content_type=None):
+        """
+        Returns the headers to send with a request.
+
+        Parameters:
+        * params: The parameters passed into the the subcommand method
+        * content_type: The content-type of the request body, if any
+        """
+        headers = dict(params.get('headers', {}))
+        if content_type is not None:
+            headers['content-type'] = content_type
+        return headers
+
+    def _apply_template(self, params):
+        """
+        Expands a template reference into full request parameters.
+        Parameters given in the message override the template.
+
+        Parameters:
+        * params: The parameters passed in the message
+        """
+        name = params['template']
+        try:
+            template = self._templates[name]
+        except KeyError:
+            raise HTTPRequestWorkerError(
+                'Unknown request template %s' % name)
+        variables = params.get('variables', {})
+        if not isinstance(variables, dict):
+            raise HTTPRequestWorkerError(
+                'Template variables must be an object, not %r' % (
+                    variables,))
+        try:
+            expanded = template.render(variables)
+        except KeyError, ke:
+            raise HTTPRequestWorkerError(
+                'Missing template variable %s' % ke)
+        for key, value in params.items():
+            if key not in ('template', 'variables'):
+                expanded[key] = value
+        return expanded
+
+    def stats(self):
+        """
+        Returns a dictionary of worker counters.
+        """
+        stats = {'processed': self._processed}
+        if self._startup_seconds is not None:
+            stats['startup_seconds'] = round(self._startup_seconds, 3)
+        if self._sessions is not None:
+            stats.update(self._sessions.tls.stats())
+        if self._concurrency is not None:
+            stats.update(self._concurrency.stats())
+        if self._hedging is not None:
+            stats.update(self._hedging.stats())
+        return stats
+
+    def _report_stats(self):
+        """
+        Logs the worker counters every stats_interval messages.
+        """
+        self._processed += 1
+        if self._stats_interval and (
+                self._processed % self._stats_interval == 0):
+            self.app_logger.info('HTTPRequestWorker stats: %s' % ', '.join(
+                '%s=%s' % item for item in sorted(self.stats().items())))
+
     def _check_code(self, response_code, params):
         """
         Raises an HTTPRequestWorkerError if the expectation isn't met.\
@@ -176,18 +571,180 @@ class HTTPRequestWorker(Worker):
         expected_code = int(params.get('code', 200))
         response_code = int(response_code)
         if response_code != expected_code:
-            self.app_logger.debug('%s != %s' % (response_code, expected_code))
+            self.app_logger.debug('%s != %s', response_code, expected_code)
+            if self._concurrency is not None and 'url' in params:
+                self._concurrency.report_unexpected(
+                    urlparse.urlsplit(params['url']).netloc, response_code)
             raise HTTPRequestWorkerError(
                 'Expected status %s but got %s' % (
                     expected_code, response_code))
         return True
 
+    def prewarm(self):
+        """
+        Opens pooled connections to the configured prewarm URLs.
+        Failures are logged and otherwise ignored.
+        """
+        import requests
+
+        for url in self._prewarm:
+            try:
+                self._session_for(url).head(url, timeout=10)
+            except requests.RequestException, rqe:
+                self.app_logger.warn(
+                    'Unable to prewarm connection to %s. Error: %s' % (
+                        url, rqe))
+
+    def drain(self, signum=None, frame=None):
+        """
+        SIGTERM handler. Exits right away when idle, otherwise once the
+        message in flight is finished.
+        """
+        self._draining = True
+        if not self._in_flight:
+            raise SystemExit(0)
+
+    def run_forever(self):
+        """
+        Prewarms connections if configured, then starts consuming.
+        """
+        signal.signal(signal.SIGTERM, self.drain)
+        signal.signal(signal.SIGUSR2, self._profiler.toggle)
+        # Restart interrupted system calls so a request in flight when a
+        # signal arrives can finish instead of failing with EINTR
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.siginterrupt(signal.SIGUSR2, False)
+        self.prewarm()
+        self._startup_seconds = time.time() - _LOADED
+        self.app_logger.info(
+            'HTTPRequestWorker ready in %.3f seconds' % self._startup_seconds)
+        Worker.run_forever(self)
+
     def process(self, channel, basic_deliver, properties, body, output):
         """
         Processes HTTPRequestWorker requests from the bus.
 
         *Keys Requires*:
-            * subcommand: the subcommand to execute.
+            * subcommand: the subcommand to execute. May instead come
+              from the template.
+
+        *Optional Keys*:
+            * template: name of a configured request template.
+            * variables: values for the template placeholders.
+            * headers: extra request headers.
+            * chunked: chunked upload options for Put and Post. See
+              replugin.httprequestworker.uploads.
+            * file: local file under file_root to upload in chunked mode
+              instead of content.
+            * path: local file under file_root a Download is written to.
+            * checksum: 'algorithm:hexdigest' a Download must match.
+            * segment_size, parallel, retries: Download segment settings.
+        """
+        lane = self._classify(body)
+        if lane is not None:
+            self._forward(basic_deliver, properties, body, lane)
+            return
+
+        self._in_flight = True
+        try:
+            self._profiler.call(
+                self._process_message,
+                channel, basic_deliver, properties, body, output)
+        finally:
+            self._in_flight = False
+        if self._draining:
+            raise SystemExit(0)
+
+    def _on_channel_open(self, channel):
+        """
+        Declares the lane queues once the channel is open so forwarded
+        messages are not dropped before the lane workers start.
+
+        Parameters:
+        * channel: The opened channel
+        """
+        Worker._on_channel_open(self, channel)
+        if self._lane is None:
+            self._check_lanes()
+
+    def _check_lanes(self):
+        """
+        Declares the lane queues and notes which have consumers.
+        """
+        self._lanes_checked = time.time()
+        for lane in self._lanes:
+            self._channel.queue_declare(
+                callback=lambda frame, lane=lane: self._lane_declared(
+                    lane, frame),
+                queue=lane.queue,
+                durable=True,
+                exclusive=False,
+                auto_delete=False)
+
+    def _lane_declared(self, lane, frame):
+        """
+        Records whether a lane queue has consumers.
+
+        Parameters:
+        * lane: The lane which was declared
+        * frame: The Queue.DeclareOk frame
+        """
+        previous = self._lane_consumers.get(lane.name)
+        consumers = frame.method.consumer_count
+        self._lane_consumers[lane.name] = consumers
+        if not consumers and previous != 0:
+            self.app_logger.warn(
+                'Lane %s has no consumers. Its messages are handled on the '
+                'main queue until it does.' % lane.name)
+
+    def _classify(self, body):
+        """
+        Returns the lane a message should be forwarded to, or None when
+        this worker should handle it. Lane workers handle everything, and
+        messages for lanes without consumers are handled here.
+
+        Parameters:
+        * body: The message body structure
+        """
+        if self._lane is not None or not self._lanes:
+            return None
+        if self._lanes_checked is not None and (
+                time.time() - self._lanes_checked > LANE_CHECK_INTERVAL):
+            self._check_lanes()
+        params = body.get('parameters', {})
+        subcommand = params.get('subcommand')
+        if subcommand is None and params.get('template') in self._templates:
+            subcommand = self._templates[params['template']].subcommand
+        lane = lanes.classify(
+            self._lanes, subcommand, lanes.content_size(params))
+        if lane is None or not self._lane_consumers.get(lane.name):
+            return None
+        return lane
+
+    def _forward(self, basic_deliver, properties, body, lane):
+        """
+        Republishes a message unchanged to a lane queue.
+
+        Parameters:
+        * basic_deliver: The delivery of the original message
+        * properties: The properties of the original message
+        * body: The message body structure
+        * lane: The lane to forward to
+        """
+        self._channel.basic_publish(
+            exchange='',
+            routing_key=lane.queue,
+            body=json.dumps(body),
+            properties=properties)
+        self.ack(basic_deliver)
+        self._events.event(
+            'message.forwarded', logging.DEBUG,
+            correlation_id=properties.correlation_id, lane=lane.name)
+
+    def _process_message(
+            self, channel, basic_deliver, properties, body, output):
+        """
+        Handles a single message for process.
         """
         # Ack the original message
         self.ack(basic_deliver)
@@ -197,6 +754,10 @@ class HTTPRequestWorker(Worker):
             properties.reply_to, corr_id, {'status': 'started'}, exchange='')
 
         try:
+            params = body.get('parameters', {})
+            if 'template' in params:
+                body['parameters'] = self._apply_template(params)
+
             try:
                 subcommand = str(body['parameters']['subcommand'])
                 if subcommand not in self.subcommands:
@@ -214,6 +775,8 @@ class HTTPRequestWorker(Worker):
                 cmd_method = self.request_post
             elif subcommand == 'Delete':
                 cmd_method = self.request_delete
+            elif subcommand == 'Download':
+                cmd_method = self.request_download
             else:
                 self.app_logger.warn(
                     'Could not find the implementation of subcommand %s' % (
@@ -237,14 +800,13 @@ class HTTPRequestWorker(Worker):
                 corr_id)
 
             # Send out responses
-            self.app_logger.info(
-                'HTTPRequestWorker successfully executed %s for '
-                'correlation_id %s. See logs.' % (
-                    subcommand, corr_id))
+            self._events.event(
+                'message.completed', subcommand=subcommand,
+                correlation_id=corr_id)
 
         except HTTPRequestWorkerError, fwe:
             # If a HTTPRequestWorkerError happens send a failure log it.
-            self.app_logger.error('Failure: %s' % fwe)
+            self.app_logger.error('Failure: %s', fwe)
             self.send(
                 properties.reply_to,
                 corr_id,
@@ -258,6 +820,23 @@ class HTTPRequestWorker(Worker):
                 corr_id)
             output.error(str(fwe))
 
+        self._report_stats()
+
+
+def preload(config):
+    """
+    Imports the transport and compiles the worker config ahead of time.
+    The supervisor calls this before forking so children share the result.
+
+    Parameters:
+    * config: The worker configuration dictionary
+    """
+    section = config.get('templates', {})
+    _preloaded[_preload_key('templates', section)] = (
+        templates.compile_templates(section))
+    section = config.get('hosts', {})
+    _preloaded[_preload_key('hosts', section)] = sessions.SessionPool(section)
+
 
 def main():  # pragma: no cover
     from reworker.worker import runner
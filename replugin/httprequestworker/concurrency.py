@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Adaptive per-host concurrency limits.
+
+Every request to a host holds a slot of that host's limit. Streamed
+responses hold it until they are closed or read to the end. The limit
+follows AIMD: each healthy response adds 1/limit (about one slot per
+round of requests) and a connection error, a 429 or 5xx response, or a
+latency above ``tolerance`` times the host's baseline multiplies it by
+``backoff``. A response whose status fails the message's expected
+``code`` backs the limit off too, once the worker has checked it. The
+baseline is the lowest smoothed latency seen, allowed to drift up
+slowly so it follows lasting changes.
+
+Requests moving at least ``transfer_bytes`` of body are timed per
+``transfer_bytes`` and kept to a baseline of their own, so large parts
+and segments are not compared against small requests. Settings live
+under the ``concurrency`` key of the worker configuration::
+
+    "concurrency": {
+        "initial": 4,
+        "minimum": 1,
+        "maximum": 64,
+        "backoff": 0.75,
+        "tolerance": 2.0,
+        "transfer_bytes": 65536
+    }
+
+The limits matter where one message sends several requests at once,
+such as chunked uploads and ranged downloads.
+"""
+
+import threading
+import time
+
+
+def overloaded(status_code):
+    """
+    Returns True if a status code suggests the host is overloaded.
+    """
+    return status_code == 429 or status_code >= 500
+
+
+class AdaptiveLimit(object):
+    """
+    An AIMD concurrency limit for one host.
+    """
+
+    #: Weight of the newest sample in the smoothed latency
+    smoothing = 0.2
+    #: Factor the baseline may rise by per sample
+    drift = 1.001
+
+    def __init__(self, initial=4, minimum=1, maximum=64, backoff=0.75,
+                 tolerance=2.0, transfer_bytes=65536):
+        """
+        Creates the limit.
+
+        Parameters:
+
+        * initial: The starting limit
+        * minimum: The lowest the limit may go
+        * maximum: The highest the limit may go
+        * backoff: Factor applied to the limit on congestion
+        * tolerance: Latency over baseline which counts as congestion
+        * transfer_bytes: Body size from which requests count as transfers
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.transfer_bytes = transfer_bytes
+        self.in_flight = 0
+        #: Smoothed latency and baseline per kind of request
+        self.latency = {}
+        self.baseline = {}
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits for a free slot and takes it.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """
+        Takes a free slot without waiting. Returns False if there is none.
+        """
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, failed=False, size=0):
+        """
+        Gives a slot back and adjusts the limit.
+
+        Parameters:
+
+        * latency: Seconds the request took
+        * failed: Whether the request failed in a way that suggests load
+        * size: Bytes of body sent and received
+        """
+        if size >= self.transfer_bytes:
+            kind = 'transfer'
+            latency = latency * self.transfer_bytes / size
+        else:
+            kind = 'request'
+        with self._condition:
+            self.in_flight -= 1
+            if kind not in self.latency:
+                self.latency[kind] = latency
+                self.baseline[kind] = latency
+            else:
+                self.latency[kind] += self.smoothing * (
+                    latency - self.latency[kind])
+                self.baseline[kind] = min(
+                    self.latency[kind], self.baseline[kind] * self.drift)
+
+            if failed or (
+                    self.latency[kind] > self.baseline[kind] * self.tolerance):
+                self.limit = max(self.minimum, self.limit * self.backoff)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def penalize(self):
+        """
+        Backs the limit off for a failure found after the slot was given
+        back, such as a status the message did not expect.
+        """
+        with self._condition:
+            self.limit = max(self.minimum, self.limit * self.backoff)
+
+
+def _body_size(data):
+    """
+    Returns the size of a request body, or 0 when it is not known.
+    """
+    if isinstance(data, basestring):
+        return len(data)
+    return 0
+
+
+def _hold(response, limit, started, sent):
+    """
+    Keeps the slot of a streamed response until it is closed or read to
+    the end, counting the bytes read.
+
+    Parameters:
+
+    * response: The streamed response
+    * limit: The AdaptiveLimit holding the slot
+    * started: When the request was sent
+    * sent: Bytes of request body sent
+    """
+    state = {'received': 0, 'released': False}
+    close = response.close
+    iter_content = response.iter_content
+
+    def release(failed=False):
+        if not state['released']:
+            state['released'] = True
+            limit.release(
+                time.time() - started, failed, sent + state['received'])
+
+    def counted_iter_content(*args, **kwargs):
+        try:
+            for chunk in iter_content(*args, **kwargs):
+                state['received'] += len(chunk)
+                yield chunk
+        except Exception:
+            release(True)
+            raise
+        release()
+
+    def closing_close():
+        try:
+            close()
+        finally:
+            release()
+
+    response.iter_content = counted_iter_content
+    response.close = closing_close
+
+
+class LimitedSession(object):
+    """
+    Session wrapper which holds a slot of a limit around each request.
+    """
+
+    def __init__(self, session, limit):
+        self._session = session
+        self._limit = limit
+        self._reserved = False
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def reserve(self):
+        """
+        Takes a slot for the next request without waiting. Returns False
+        if the limit is full.
+        """
+        self._reserved = self._limit.try_acquire()
+        return self._reserved
+
+    def _call(self, method, *args, **kwargs):
+        if self._reserved:
+            self._reserved = False
+        else:
+            self._limit.acquire()
+        started = time.time()
+        try:
+            response = getattr(self._session, method)(*args, **kwargs)
+        except Exception:
+            self._limit.release(time.time() - started, True)
+            raise
+        failed = overloaded(response.status_code)
+        sent = _body_size(kwargs.get('data'))
+        if kwargs.get('stream', False) and not failed:
+            _hold(response, self._limit, started, sent)
+        else:
+            self._limit.release(time.time() - started, failed, sent)
+        return response
+
+    def get(self, *args, **kwargs):
+        return self._call('get', *args, **kwargs)
+
+    def head(self, *args, **kwargs):
+        return self._call('head', *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self._call('put', *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self._call('post', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._call('delete', *args, **kwargs)
+
+
+class ConcurrencyController(object):
+    """
+    Keeps one AdaptiveLimit per host.
+    """
+
+    def __init__(self, **settings):
+        """
+        Creates the controller.
+
+        Parameters:
+
+        * settings: Keyword arguments for each AdaptiveLimit
+        """
+        self._settings = settings
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def limit_for(self, host):
+        """
+        Returns the limit for host, creating it on first use.
+        """
+        with self._lock:
+            if host not in self._limits:
+                self._limits[host] = AdaptiveLimit(**self._settings)
+            return self._limits[host]
+
+    def report_unexpected(self, host, status_code):
+        """
+        Backs off the limit for host after a status the message did not
+        expect. Overload statuses were already counted on release.
+
+        Parameters:
+
+        * host: The host which answered
+        * status_code: The status it answered with
+        """
+        if not overloaded(status_code):
+            self.limit_for(host).penalize()
+
+    def wrap(self, host, session):
+        """
+        Returns session wrapped to respect the limit for host.
+        """
+        return LimitedSession(session, self.limit_for(host))
+
+    def stats(self):
+        """
+        Returns the current limit of every host for reporting.
+        """
+        return dict(
+            ('concurrency_limit:%s' % host, int(limit.limit))
+            for host, limit in self._limits.items())
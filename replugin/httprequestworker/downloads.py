@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Streaming downloads to local files.
+
+Download messages name the local ``path`` to write, which must be
+inside the worker's ``file_root``. The body is written to ``<path>.part`` and renamed to ``path`` once it
+is complete and its checksum, if given, matches. When the server
+answers with ``Accept-Ranges: bytes`` and a ``Content-Length`` the file
+is fetched as ranged segments in parallel. Finished segments are
+recorded in ``<path>.part.json`` so a later attempt only fetches what
+is missing, as long as the size and ETag/Last-Modified are unchanged.
+Other responses are streamed to disk in one pass. Partial files are
+removed on failure unless they hold recorded segments to resume from.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+#: Bytes read from the network per write
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+    """
+    Raised when a download can not be completed.
+    """
+    pass
+
+
+class SegmentError(DownloadError):
+    """
+    Raised when ranged segments fail. Finished segments are kept so a
+    later attempt can resume.
+    """
+    pass
+
+
+def parse_checksum(checksum):
+    """
+    Returns (algorithm, hexdigest) from an 'algorithm:hexdigest' string.
+
+    Parameters:
+
+    * checksum: The checksum string to parse
+    """
+    try:
+        algorithm, expected = checksum.split(':', 1)
+        hashlib.new(algorithm)
+    except (AttributeError, ValueError):
+        raise DownloadError(
+            'Invalid checksum %r. Expected algorithm:hexdigest with a '
+            'hashlib algorithm such as sha256' % (checksum,))
+    return algorithm, expected.lower()
+
+
+def file_checksum(path, algorithm):
+    """
+    Returns the hex digest of a file.
+
+    Parameters:
+
+    * path: The file to hash
+    * algorithm: A hashlib algorithm name such as sha256
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Downloader(object):
+    """
+    Downloads a URL to a local path over a pooled session.
+    """
+
+    def __init__(self, session, url, path, headers=None,
+                 segment_size=8 * 1024 * 1024, parallel=4, retries=3):
+        """
+        Creates the downloader.
+
+        Parameters:
+
+        * session: The session to send requests with
+        * url: The URL to download
+        * path: The local path to write to
+        * headers: Extra headers to send with every request
+        * segment_size: Size of each ranged segment in bytes
+        * parallel: How many segments to fetch at once
+        * retries: Attempts per segment before giving up
+        """
+        self.session = session
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.json'
+        self.headers = headers or {}
+        self.segment_size = int(segment_size)
+        self.parallel = max(1, int(parallel))
+        self.retries = max(1, int(retries))
+        self._lock = threading.Lock()
+        self._state = None
+
+    def fetch(self, response, checksum=None):
+        """
+        Writes the download to path and returns the number of bytes.
+
+        Parameters:
+
+        * response: The streaming GET response for the URL
+        * checksum: Optional 'algorithm:hexdigest' the file must match
+        """
+        if checksum:
+            algorithm, expected = parse_checksum(checksum)
+        try:
+            size = response.headers.get('Content-Length')
+            if (response.status_code == 200 and size is not None and
+                    response.headers.get('Accept-Ranges') == 'bytes'):
+                validator = (response.headers.get('ETag') or
+                             response.headers.get('Last-Modified'))
+                response.close()
+                self._fetch_ranged(int(size), validator)
+            else:
+                self._fetch_stream(response)
+
+            if checksum:
+                actual = file_checksum(self.part_path, algorithm)
+                if actual != expected:
+                    raise DownloadError(
+                        'Checksum mismatch for %s: expected %s got %s' % (
+                            self.url, expected, actual))
+            os.rename(self.part_path, self.path)
+        except SegmentError:
+            raise
+        except Exception:
+            self._discard()
+            raise
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return os.path.getsize(self.path)
+
+    def _discard(self):
+        """
+        Removes the partial file and its state.
+        """
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fetch_stream(self, response):
+        """
+        Streams a whole response body to the partial file.
+        """
+        try:
+            with open(self.part_path, 'wb') as target:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    target.write(chunk)
+        finally:
+            response.close()
+
+    # Ranged segments
+    def segments(self, size):
+        """
+        Returns (index, start, end) for every segment. End is inclusive.
+        """
+        return [
+            (index, start, min(start + self.segment_size, size) - 1)
+            for index, start in enumerate(
+                range(0, size, self.segment_size))]
+
+    def _load_state(self, size, validator):
+        """
+        Returns saved progress when it matches this download, else a
+        fresh state with the partial file preallocated.
+        """
+        if os.path.exists(self.state_path) and os.path.exists(
+                self.part_path):
+            try:
+                with open(self.state_path, 'r') as state_file:
+                    state = json.load(state_file)
+                if (state.get('size') == size and
+                        state.get('validator') == validator and
+                        state.get('segment_size') == self.segment_size):
+                    return state
+            except ValueError:
+                pass
+        with open(self.part_path, 'wb') as target:
+            target.truncate(size)
+        return {
+            'size': size,
+            'validator': validator,
+            'segment_size': self.segment_size,
+            'done': [],
+        }
+
+    def _save_state(self, index):
+        """
+        Records a finished segment.
+        """
+        with self._lock:
+            self._state['done'].append(index)
+            with open(self.state_path, 'w') as state_file:
+                json.dump(self._state, state_file)
+
+    def _fetch_ranged(self, size, validator):
+        """
+        Fetches the missing segments in parallel. Every finished segment
+        is recorded even when others fail.
+        """
+        self._state = self._load_state(size, validator)
+        done = set(self._state['done'])
+        pending = [s for s in self.segments(size) if s[0] not in done]
+        failures = []
+        pool = ThreadPool(self.parallel)
+        try:
+            for index, error in pool.imap_unordered(
+                    self._fetch_segment, pending):
+                if error is None:
+                    self._save_state(index)
+                else:
+                    failures.append(error)
+        finally:
+            pool.close()
+            pool.join()
+        if failures:
+            raise SegmentError(
+                '%s of %s segments failed. First error: %s' % (
+                    len(failures), len(pending), failures[0]))
+
+    def _fetch_segment(self, segment):
+        """
+        Fetches one segment into place, retrying on failure. Returns
+        (index, None) on success or (index, error).
+        """
+        index, start, end = segment
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%s-%s' % (start, end)
+        error = None
+        for attempt in range(self.retries):
+            try:
+                response = self.session.get(
+                    self.url, headers=headers, stream=True)
+                try:
+                    if response.status_code != 206:
+                        error = 'status %s' % response.status_code
+                        continue
+                    written = 0
+                    with open(self.part_path, 'r+b') as target:
+                        target.seek(start)
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            target.write(chunk)
+                            written += len(chunk)
+                finally:
+                    response.close()
+            except requests.RequestException, rqe:
+                error = rqe
+                continue
+            if written == end - start + 1:
+                return index, None
+            error = 'short read of %s bytes' % written
+        return index, 'segment %s-%s failed after %s attempts: %s' % (
+            start, end, self.retries, error)
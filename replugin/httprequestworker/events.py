@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Structured, sampled event logging for the request path.
+
+Settings live under the ``logging`` key of the worker configuration::
+
+    "logging": {
+        "sample_rates": {"http.response": 0.01, "message.completed": 0.1},
+        "async": true,
+        "buffer": 10000
+    }
+
+A sample rate of 0.01 logs one in every 100 events of that type. Events
+without a rate are always logged. Sampled events carry a ``sample``
+field holding N so counts can be scaled back up. With ``async`` set the
+worker's log handlers are fed from a bounded queue by a background
+thread; records are dropped rather than blocking when it is full.
+"""
+
+import logging
+import threading
+import time
+import Queue
+
+
+class _Fields(object):
+    """
+    Event fields which are only formatted if the record is emitted.
+    """
+
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join(
+            '%s=%s' % (key, self.fields[key]) for key in sorted(self.fields))
+
+
+class EventLogger(object):
+    """
+    Logs named events with key/value fields at per-event sample rates.
+    """
+
+    def __init__(self, logger, sample_rates=None):
+        """
+        Creates the event logger.
+
+        Parameters:
+
+        * logger: The logger to emit on
+        * sample_rates: Mapping of event name to the fraction to log
+        """
+        self.logger = logger
+        self._every = {}
+        self._counts = {}
+        for name, rate in (sample_rates or {}).items():
+            rate = float(rate)
+            if rate <= 0:
+                self._every[name] = 0
+            else:
+                self._every[name] = max(1, int(round(1.0 / rate)))
+
+    def event(self, name, level=logging.INFO, **fields):
+        """
+        Logs an event if its level is enabled and it is sampled.
+
+        Parameters:
+
+        * name: The event type
+        * level: The logging level
+        * fields: Key/value data for the event
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        every = self._every.get(name, 1)
+        if every != 1:
+            if every == 0:
+                return
+            count = self._counts.get(name, 0)
+            self._counts[name] = count + 1
+            if count % every:
+                return
+            fields['sample'] = every
+        self.logger.log(level, '%s %s', name, _Fields(fields))
+
+
+class BufferedAsyncHandler(logging.Handler):
+    """
+    Hands records to a target handler from a background thread.
+    """
+
+    def __init__(self, target, capacity=10000, flush_timeout=5.0):
+        """
+        Creates the handler and starts its thread.
+
+        Parameters:
+
+        * target: The handler which does the real output
+        * capacity: How many records may wait before new ones are dropped
+        * flush_timeout: Longest flush() waits for queued records
+        """
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self.flush_timeout = flush_timeout
+        self.dropped = 0
+        self._closed = False
+        self._queue = Queue.Queue(capacity)
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _drain(self):
+        while True:
+            record = self._queue.get()
+            try:
+                # None is put by close()
+                if record is None:
+                    return
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=None):
+        """
+        Waits until queued records have been handed on, for at most
+        timeout seconds so a stuck target can not hang shutdown.
+
+        Parameters:
+
+        * timeout: Seconds to wait. Defaults to flush_timeout
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        deadline = time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self._queue.all_tasks_done.wait(remaining)
+        self.target.flush()
+
+    def close(self):
+        """
+        Flushes what it can and stops the background thread.
+        """
+        if not self._closed:
+            self.flush()
+            self._closed = True
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                # The target is stuck. The daemon thread dies with us.
+                pass
+            self._thread.join(self.flush_timeout)
+        logging.Handler.close(self)
+
+
+def make_async(logger, capacity=10000):
+    """
+    Swaps the handlers of logger for BufferedAsyncHandler wrappers.
+
+    Parameters:
+
+    * logger: The logger whose handlers to wrap
+    * capacity: See BufferedAsyncHandler
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, BufferedAsyncHandler):
+            continue
+        logger.removeHandler(handler)
+        logger.addHandler(BufferedAsyncHandler(handler, capacity))
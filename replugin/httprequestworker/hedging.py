@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Hedged requests.
+
+A Get message with ``"hedge": true`` sends its request and, if no
+response has arrived after the ``percentile`` latency recently seen for
+the host, sends an identical second request on another pooled
+connection. The first successful response wins. A request can not be
+interrupted once sent, so the losing response is closed as soon as it
+arrives and its connection goes back to the pool. Settings live under
+the ``hedging`` key of the worker configuration::
+
+    "hedging": {
+        "percentile": 95,
+        "budget": 0.05,
+        "min_delay": 0.01,
+        "min_samples": 20,
+        "window": 200
+    }
+
+``budget`` caps second requests to that fraction of hedged requests, so
+hedging adds at most that much extra load. Hosts with fewer than
+``min_samples`` recorded latencies are not hedged. Neither are requests
+whose host has no free concurrency slot when the delay runs out, since
+a second request left waiting for one would go out too late to help.
+"""
+
+import Queue
+import collections
+import math
+import threading
+import time
+
+
+def _succeeded(result):
+    """
+    Returns True if a result holds a response below 500.
+    """
+    attempt, response, error, duration = result
+    return error is None and response.status_code < 500
+
+
+def _discard(result):
+    """
+    Closes the response of a result which lost. Errors are ignored since
+    this may run in the losing attempt's thread.
+    """
+    if result[1] is not None:
+        try:
+            result[1].close()
+        except Exception:
+            pass
+
+
+class _Race(object):
+    """
+    Runs attempts of one request in threads and collects their results.
+    """
+
+    def __init__(self, call):
+        """
+        Creates the race.
+
+        Parameters:
+
+        * call: Callable taking the attempt number and returning a response
+        """
+        self._call = call
+        self._lock = threading.Lock()
+        self._results = Queue.Queue()
+        self._decided = False
+        self.started = 0
+
+    def start(self, attempt):
+        """
+        Starts an attempt in a new thread.
+        """
+        self.started += 1
+        thread = threading.Thread(target=self._run, args=(attempt,))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, attempt):
+        started = time.time()
+        try:
+            result = (attempt, self._call(attempt), None)
+        except Exception, e:
+            result = (attempt, None, e)
+        result += (time.time() - started,)
+        with self._lock:
+            if self._decided:
+                _discard(result)
+            else:
+                self._results.put(result)
+
+    def wait(self, timeout=None):
+        """
+        Returns the next result, or None if timeout passes first.
+        """
+        try:
+            return self._results.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def decide(self):
+        """
+        Ends the race. Results still arriving are discarded.
+        """
+        with self._lock:
+            self._decided = True
+            while True:
+                try:
+                    _discard(self._results.get_nowait())
+                except Queue.Empty:
+                    break
+
+
+class Hedger(object):
+    """
+    Sends requests with a delayed second attempt within a budget.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, min_delay=0.01,
+                 min_samples=20, window=200):
+        """
+        Creates the hedger.
+
+        Parameters:
+
+        * percentile: Latency percentile to wait for before hedging
+        * budget: Largest fraction of requests which may be hedged
+        * min_delay: Shortest wait in seconds before hedging
+        * min_samples: Latencies needed for a host before hedging it
+        * window: How many recent latencies to keep per host
+        """
+        self.percentile = float(percentile)
+        self.budget = float(budget)
+        self.min_delay = float(min_delay)
+        self.min_samples = max(1, int(min_samples))
+        self.window = int(window)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, host, seconds):
+        """
+        Records the latency of a successful request to host.
+        """
+        with self._lock:
+            if host not in self._latencies:
+                self._latencies[host] = collections.deque(maxlen=self.window)
+            self._latencies[host].append(seconds)
+
+    def delay_for(self, host):
+        """
+        Returns seconds to wait before hedging a request to host, or None
+        if too few latencies are known.
+        """
+        with self._lock:
+            samples = sorted(self._latencies.get(host, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = int(math.ceil(self.percentile / 100 * len(samples))) - 1
+        return max(self.min_delay, samples[max(0, index)])
+
+    def _take_budget(self, reserve=None):
+        """
+        Returns True and counts a hedge if the budget allows one more and
+        reserve, when given, returns True.
+        """
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            if reserve is not None and not reserve():
+                return False
+            self.hedges += 1
+            return True
+
+    def send(self, host, call, reserve=None):
+        """
+        Sends a request, hedging it when it is slow. Returns the first
+        successful response. When no attempt succeeds the outcome of the
+        first attempt is returned or raised.
+
+        Parameters:
+
+        * host: The host the request goes to
+        * call: Callable taking the attempt number and returning a response
+        * reserve: Callable taking a slot for the second attempt without
+          waiting. The request is not hedged when it returns False.
+        """
+        with self._lock:
+            self.requests += 1
+        race = _Race(call)
+        race.start(1)
+        delay = self.delay_for(host)
+        result = race.wait(delay)
+        if result is None:
+            if self._take_budget(reserve):
+                race.start(2)
+            result = race.wait()
+
+        results = [result]
+        while not _succeeded(results[-1]) and len(results) < race.started:
+            results.append(race.wait())
+        race.decide()
+
+        winner = None
+        for result in results:
+            if _succeeded(result):
+                self.record(host, result[3])
+                if winner is None:
+                    winner = result
+        if winner is None:
+            # Every attempt started has reported back
+            winner = [result for result in results if result[0] == 1][0]
+        elif winner[0] != 1:
+            with self._lock:
+                self.wins += 1
+        for result in results:
+            if result is not winner:
+                _discard(result)
+        if winner[2] is not None:
+            raise winner[2]
+        return winner[1]
+
+    def stats(self):
+        """
+        Returns hedging counters for reporting.
+        """
+        return {
+            'hedge_requests': self.requests,
+            'hedges_sent': self.hedges,
+            'hedge_wins': self.wins,
+        }
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Priority lanes.
+
+Lanes are listed under the ``lanes`` key of the worker configuration.
+Workers consuming the main queue classify each message against the
+lanes in order and forward it to the queue of the first lane that
+matches. Messages matching no lane go to the catch-all ``default``
+lane, so a slow message never holds up classification of the ones
+behind it. Unless configured, the default lane is added with the queue
+``<queue>.default``::
+
+    "lanes": [
+        {"name": "checks", "queue": "httprequest.checks",
+         "subcommands": ["Get"], "max_content_bytes": 0, "processes": 4},
+        {"name": "bulk", "queue": "httprequest.bulk",
+         "min_content_bytes": 1048576, "processes": 1}
+    ]
+
+``processes`` is the lane's concurrency budget: the number of workers
+the supervisor runs for it. A worker serves a lane when the
+``RE_WORKER_HTTPREQUEST_LANE`` environment variable names it. Main queue
+workers only forward to lanes which have consumers and handle messages
+for the others themselves, so nothing is stranded in a lane queue that
+no worker reads.
+"""
+
+import os
+
+#: Environment variable naming the lane a worker process serves
+LANE_ENV = 'RE_WORKER_HTTPREQUEST_LANE'
+#: Name of the lane taking messages no other lane matches
+DEFAULT_LANE = 'default'
+
+
+class Lane(object):
+    """
+    A queue with its own concurrency budget and classification rules.
+    """
+
+    def __init__(self, name, queue, processes=1, subcommands=None,
+                 min_content_bytes=None, max_content_bytes=None):
+        """
+        Creates the lane.
+
+        Parameters:
+
+        * name: The lane name
+        * queue: The queue the lane's workers consume
+        * processes: How many workers the supervisor runs for the lane
+        * subcommands: Subcommands the lane takes. None for any
+        * min_content_bytes: Smallest body size the lane takes, if any
+        * max_content_bytes: Largest body size the lane takes, if any
+        """
+        self.name = name
+        self.queue = queue
+        self.processes = int(processes)
+        self.subcommands = subcommands
+        self.min_content_bytes = min_content_bytes
+        self.max_content_bytes = max_content_bytes
+
+    def matches(self, subcommand, size):
+        """
+        Returns True if a message belongs in this lane.
+
+        Parameters:
+
+        * subcommand: The subcommand of the message
+        * size: The size of the message body content in bytes
+        """
+        if self.subcommands is not None and (
+                subcommand not in self.subcommands):
+            return False
+        if self.min_content_bytes is not None and (
+                size < self.min_content_bytes):
+            return False
+        if self.max_content_bytes is not None and (
+                size > self.max_content_bytes):
+            return False
+        return True
+
+
+def load_lanes(config, queue=None):
+    """
+    Creates the lanes from the lanes section of the worker config.
+
+    Parameters:
+
+    * config: List of lane dictionaries
+    * queue: The main queue. When given and lanes are configured, a
+      default lane is added unless one is configured.
+    """
+    result = []
+    for item in config:
+        try:
+            result.append(Lane(**item))
+        except TypeError, te:
+            raise ValueError('Invalid lane %s: %s' % (item, te))
+    if result and queue is not None and DEFAULT_LANE not in [
+            lane.name for lane in result]:
+        result.append(Lane(DEFAULT_LANE, '%s.%s' % (queue, DEFAULT_LANE)))
+    return result
+
+
+def content_size(params):
+    """
+    Returns the size in bytes of the content a message sends.
+
+    Parameters:
+
+    * params: The message parameters
+    """
+    if 'file' in params:
+        try:
+            return os.path.getsize(params['file'])
+        except OSError:
+            return 0
+    size = len(params.get('content', ''))
+    if params.get('b64encoded', False):
+        size = size * 3 / 4
+    return size
+
+
+def classify(lanes, subcommand, size):
+    """
+    Returns the first lane matching a message, else the default lane if
+    there is one, else None.
+
+    Parameters:
+
+    * lanes: The lanes to check in order
+    * subcommand: The subcommand of the message
+    * size: The size of the message body content in bytes
+    """
+    default = None
+    for lane in lanes:
+        if lane.matches(subcommand, size):
+            return lane
+        if lane.name == DEFAULT_LANE:
+            default = lane
+    return default
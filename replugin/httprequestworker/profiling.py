@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Opt-in per-message profiling.
+
+Settings live under the ``profiling`` key of the worker configuration::
+
+    "profiling": {
+        "enabled": false,
+        "sample_every": 100,
+        "dump_every": 10,
+        "output_dir": "/var/tmp/re-worker-httprequest",
+        "trace_allocations": true
+    }
+
+When enabled one in every ``sample_every`` messages runs under cProfile.
+Stats are aggregated and written as a ``.pstats`` file after every
+``dump_every`` profiled messages, ready for ``pstats`` or ``snakeviz``.
+With ``trace_allocations`` set, the objects tracked by the garbage
+collector are counted per type and the resident set size is read before
+and after each profiled message. The growth still held afterwards is
+summed and written next to the stats as ``.alloc`` text. Counting walks
+every tracked object, so it is only done for profiled messages. Sending
+the worker SIGUSR2 toggles profiling at runtime. cProfile and pstats are
+only imported once a call is profiled.
+"""
+
+import gc
+import logging
+import os
+import resource
+import time
+
+
+def _object_counts():
+    """
+    Returns the number of gc tracked objects per type name.
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def _rss_bytes():
+    """
+    Returns the resident set size of this process, or None if unknown.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class MessageProfiler(object):
+    """
+    Profiles a sample of calls and periodically writes the aggregate.
+    """
+
+    def __init__(self, enabled=False, sample_every=100, dump_every=10,
+                 output_dir='/tmp', trace_allocations=False, logger=None):
+        """
+        Creates the profiler.
+
+        Parameters:
+
+        * enabled: Whether to start profiling right away
+        * sample_every: Profile one in this many calls
+        * dump_every: Write the aggregate after this many profiled calls
+        * output_dir: Directory the aggregates are written to
+        * trace_allocations: Whether to trace allocations as well
+        * logger: The logger to report problems on
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.enabled = enabled
+        self.sample_every = max(1, int(sample_every))
+        self.dump_every = max(1, int(dump_every))
+        self.output_dir = output_dir
+        self.trace_allocations = trace_allocations
+        self._seen = 0
+        self._profiled = 0
+        self._stats = None
+        self._allocations = {}
+        self._rss_growth = 0
+
+    def toggle(self, signum=None, frame=None):
+        """
+        Turns profiling on or off. Usable as a signal handler.
+        """
+        self.enabled = not self.enabled
+        if not self.enabled and self._stats is not None:
+            self.dump()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func, profiling it when the call is sampled.
+
+        Parameters:
+
+        * func: The callable to run
+        * args: Positional arguments for func
+        * kwargs: Keyword arguments for func
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        self._seen += 1
+        if self._seen % self.sample_every:
+            return func(*args, **kwargs)
+
+        import cProfile
+        import pstats
+
+        profile = cProfile.Profile()
+        before = None
+        if self.trace_allocations:
+            before = (_object_counts(), _rss_bytes())
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            if before is not None:
+                self._add_allocations(*before)
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._profiled += 1
+            if self._profiled % self.dump_every == 0:
+                self.dump()
+
+    def _add_allocations(self, counts, rss):
+        """
+        Adds the growth since counts and rss were taken to the aggregate.
+
+        Parameters:
+
+        * counts: Object counts per type name from before the call
+        * rss: Resident set size in bytes from before the call, or None
+        """
+        for name, count in _object_counts().items():
+            growth = count - counts.get(name, 0)
+            if growth:
+                self._allocations[name] = (
+                    self._allocations.get(name, 0) + growth)
+        now = _rss_bytes()
+        if rss is not None and now is not None:
+            self._rss_growth += now - rss
+
+    def dump(self):
+        """
+        Writes the aggregated profile and resets it. Returns the path of
+        the stats file or None if nothing was profiled or it could not be
+        written. Write errors are logged rather than raised since this
+        runs after profiled calls and from the SIGUSR2 handler.
+        """
+        if self._stats is None:
+            return None
+        path = os.path.join(
+            self.output_dir, 'httprequest-%s-%s-%s.pstats' % (
+                os.getpid(), int(time.time()), self._profiled))
+        try:
+            if not os.path.isdir(self.output_dir):
+                os.makedirs(self.output_dir)
+            self._stats.dump_stats(path)
+            if self.trace_allocations:
+                with open(
+                        path[:-len('.pstats')] + '.alloc', 'w') as alloc_file:
+                    alloc_file.write('rss_growth=%s\n' % self._rss_growth)
+                    for name, growth in sorted(
+                            self._allocations.items(),
+                            key=lambda item: item[1], reverse=True):
+                        alloc_file.write('%s objects=%+d\n' % (name, growth))
+        except (IOError, OSError), ioe:
+            self.logger.error(
+                'Unable to write profile to %s. Error: %s' % (
+                    self.output_dir, ioe))
+            path = None
+        self._stats = None
+        self._allocations = {}
+        self._rss_growth = 0
+        return path
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pooled sessions with per-host profiles.
+
+Profiles live under the ``hosts`` key of the worker configuration and
+are keyed by ``host:port`` or by host name::
+
+    "hosts": {
+        "api.example.com": {
+            "headers": {"Accept": "application/json"},
+            "auth": {"type": "basic", "username": "re", "password_file": "/etc/re/pw"},
+            "verify": "/etc/pki/tls/certs/internal-ca.pem",
+            "proxies": {"https": "http://proxy.example.com:3128"}
+        },
+        "deploy.example.com:8443": {
+            "auth": {"type": "cert", "cert": "/etc/re/client.pem", "key": "/etc/re/client.key"}
+        }
+    }
+
+Supported auth types are ``basic`` (``username`` plus ``password`` or
+``password_file``), ``bearer`` (``token`` or ``token_file``) and
+``cert`` (``cert`` and optional ``key``). Credentials are read once when
+the session is built.
+
+TLS trust and client certs are loaded into contexts shared through a
+replugin.httprequestworker.tls.TLSContextRegistry.
+
+requests is only imported once a session is built, so check_profile()
+can validate the profiles at startup without loading the transport.
+"""
+
+import os
+import urlparse
+
+#: Keys each auth type needs
+_AUTH_KEYS = {
+    'basic': ('username', 'password'),
+    'bearer': ('token',),
+    'cert': ('cert',),
+}
+#: Auth keys which may instead be read from a <name>_file key
+_SECRET_KEYS = ('password', 'token')
+
+
+def _check_path(host, name, path):
+    """
+    Raises ValueError naming host if a configured path can not be read.
+    """
+    if not os.access(path, os.R_OK):
+        raise ValueError(
+            'Can not read %s %s for host %s' % (name, path, host))
+
+
+def check_profile(host, profile):
+    """
+    Raises ValueError naming host if a profile is incomplete or names
+    files which can not be read.
+
+    Parameters:
+
+    * host: The host the profile is for
+    * profile: Dictionary of host profile settings
+    """
+    verify = profile.get('verify', True)
+    if verify is not True and verify is not False:
+        _check_path(host, 'verify', verify)
+    auth = profile.get('auth')
+    if not auth:
+        return
+    auth_type = auth.get('type')
+    if auth_type not in _AUTH_KEYS:
+        raise ValueError(
+            'Unknown auth type %s for host %s' % (auth_type, host))
+    for name in _AUTH_KEYS[auth_type]:
+        if name in auth:
+            continue
+        if name in _SECRET_KEYS and name + '_file' in auth:
+            continue
+        raise ValueError(
+            'Missing %s in %s auth for host %s' % (name, auth_type, host))
+    for name in ('password_file', 'token_file', 'cert', 'key'):
+        if name in auth:
+            _check_path(host, name, auth[name])
+
+
+def _secret(auth, name):
+    """
+    Returns a secret given inline or through a <name>_file key.
+    """
+    if name in auth:
+        return auth[name]
+    with open(auth[name + '_file'], 'r') as secret_file:
+        return secret_file.read().strip()
+
+
+def build_session(profile, tls_registry, host=None):
+    """
+    Creates a session with the profile settings applied.
+
+    Parameters:
+
+    * profile: Dictionary of host profile settings
+    * tls_registry: The TLSContextRegistry to take TLS contexts from
+    * host: The host the profile is for, used in error messages
+    """
+    import requests
+    from replugin.httprequestworker import tls
+
+    check_profile(host, profile)
+    session = requests.Session()
+    session.headers.update(profile.get('headers', {}))
+
+    cert = None
+    auth = profile.get('auth')
+    if auth:
+        auth_type = auth.get('type')
+        if auth_type == 'basic':
+            session.auth = (auth['username'], _secret(auth, 'password'))
+        elif auth_type == 'bearer':
+            session.headers['Authorization'] = (
+                'Bearer %s' % _secret(auth, 'token'))
+        elif auth_type == 'cert':
+            if 'key' in auth:
+                cert = (auth['cert'], auth['key'])
+            else:
+                cert = auth['cert']
+
+    verify = profile.get('verify', True)
+    session.mount('https://', tls.TLSContextAdapter(
+        tls_registry.context_for(verify, cert)))
+    # The CA bundle itself lives in the shared context
+    session.verify = verify is not False
+
+    if 'proxies' in profile:
+        session.proxies.update(profile['proxies'])
+    return session
+
+
+class SessionPool(object):
+    """
+    Hands out one pooled session per configured host profile. Hosts
+    without a profile share a default session.
+    """
+
+    def __init__(self, profiles):
+        """
+        Creates the pool and resolves every profile.
+
+        Parameters:
+
+        * profiles: Mapping of host to profile settings
+        """
+        from replugin.httprequestworker import tls
+
+        self._profiles = profiles
+        self.tls = tls.TLSContextRegistry()
+        self._sessions = {}
+        self._default = build_session({}, self.tls)
+        for key, profile in profiles.items():
+            self._sessions[key] = build_session(profile, self.tls, key)
+
+    def profile_key(self, url):
+        """
+        Returns the profile key which applies to url, or None.
+
+        Parameters:
+
+        * url: The URL about to be requested
+        """
+        parsed = urlparse.urlparse(url)
+        if parsed.netloc in self._profiles:
+            return parsed.netloc
+        if parsed.hostname in self._profiles:
+            return parsed.hostname
+        return None
+
+    def session_for(self, url):
+        """
+        Returns the session to use for url.
+
+        Parameters:
+
+        * url: The URL about to be requested
+        """
+        key = self.profile_key(url)
+        if key is None:
+            return self._default
+        return self._sessions[key]
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Multi-process supervisor for the HTTP Request worker.
+
+Usage::
+
+    re-worker-httprequest-supervisor [-p N] [--preload WORKER_CONFIG] \\
+        WORKER_ARGS...
+
+Every argument the supervisor does not know is handed to the regular
+worker runner in each child. ``--preload`` compiles the worker config
+before forking so children share it copy-on-write. Lanes are only known
+to the supervisor through ``--preload``. When the preloaded config
+defines lanes, each lane gets its ``processes`` workers, the ``-p``
+workers serve the default lane unless it is configured, and a single
+worker routes the main queue. Without ``--preload`` the lane queues
+have no consumers, so the ``-p`` workers handle every message on the
+main queue themselves.
+"""
+
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+
+
+class Supervisor(object):
+    """
+    Forks and watches a fixed set of worker processes.
+    """
+
+    def __init__(self, target, slots, logger, restart_delay=1.0):
+        """
+        Creates the supervisor.
+
+        Parameters:
+
+        * target: Callable run in each child with its slot
+        * slots: One slot name per child to keep running
+        * logger: The logger to report on
+        * restart_delay: Seconds to wait before replacing a dead child
+        """
+        self._target = target
+        self.slots = slots
+        self.logger = logger
+        self.restart_delay = restart_delay
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, slot):
+        """
+        Forks a child to run the target.
+
+        Parameters:
+
+        * slot: The slot the child fills
+        """
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                self._target(slot)
+            except SystemExit, se:
+                code = se.code if isinstance(se.code, int) else 0
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        self.children[pid] = slot
+        self.logger.info('Started worker %s as pid %s' % (slot, pid))
+        return pid
+
+    def reap(self, pid, status):
+        """
+        Handles a child exit, replacing it unless stopping.
+
+        Parameters:
+
+        * pid: The pid of the child which exited
+        * status: The status returned by os.wait
+        """
+        slot = self.children.pop(pid, None)
+        if slot is None:
+            return
+        if self.stopping:
+            self.logger.info('Worker %s (pid %s) stopped' % (slot, pid))
+            return
+        self.logger.warn(
+            'Worker %s (pid %s) exited with status %s. Restarting.' % (
+                slot, pid, status))
+        time.sleep(self.restart_delay)
+        # stop() may have run during the sleep
+        if self.stopping:
+            return
+        self.spawn(slot)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Asks every child to drain and exit.
+        """
+        self.stopping = True
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, oe:
+                if oe.errno != errno.ESRCH:
+                    raise
+
+    def run(self):
+        """
+        Starts the children and supervises them until they are stopped.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in self.slots:
+            self.spawn(slot)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, oe:
+                if oe.errno == errno.EINTR:
+                    continue
+                raise
+            self.reap(pid, status)
+
+
+def main():  # pragma: no cover
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Runs several HTTP Request workers.')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=multiprocessing.cpu_count(),
+        help='Number of worker processes, or of default lane workers when '
+        'lanes are preloaded. Defaults to one per core.')
+    parser.add_argument(
+        '--preload', metavar='WORKER_CONFIG',
+        help='Worker config to compile before forking.')
+    args, worker_args = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger('re-worker-httprequest-supervisor')
+
+    from replugin import httprequestworker
+    from replugin.httprequestworker import lanes
+
+    config = {}
+    if args.preload:
+        with open(args.preload, 'r') as config_file:
+            config = json.load(config_file)
+        httprequestworker.preload(config)
+    configured = [lane.get('name') for lane in config.get('lanes', [])]
+    lane_list = lanes.load_lanes(config.get('lanes', []), config.get('queue'))
+
+    slot_lanes = {}
+    # With lanes the main queue workers only route, so one is enough
+    for index in range(1 if lane_list else args.processes):
+        slot_lanes['main/%s' % index] = None
+    for lane in lane_list:
+        processes = lane.processes
+        if lane.name == lanes.DEFAULT_LANE and (
+                lanes.DEFAULT_LANE not in configured):
+            processes = args.processes
+        for index in range(processes):
+            slot_lanes['%s/%s' % (lane.name, index)] = lane.name
+
+    # The runner in each child parses the remaining arguments
+    sys.argv = [sys.argv[0]] + worker_args
+
+    def run_worker(slot):
+        from reworker.worker import runner
+        if slot_lanes[slot]:
+            os.environ[lanes.LANE_ENV] = slot_lanes[slot]
+        runner(httprequestworker.HTTPRequestWorker)
+
+    Supervisor(run_worker, sorted(slot_lanes), logger).run()
+
+
+if __name__ == '__main__':  # pragma nocover
+    main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Precompiled request templates.
+
+Templates are defined once in the worker configuration and referenced
+by name from messages::
+
+    "templates": {
+        "status": {
+            "subcommand": "Get",
+            "url": "http://${host}/status",
+            "headers": {"X-Release": "${version}"},
+            "code": 200
+        }
+    }
+
+Placeholders use ``string.Template`` syntax (``$name`` or ``${name}``)
+so JSON content does not need its braces escaped. Use ``$$`` for a
+literal dollar sign.
+"""
+
+import string
+
+
+class CompiledString(object):
+    """
+    A string split once into literal and placeholder parts.
+    """
+
+    def __init__(self, text):
+        """
+        Creates the compiled string.
+
+        Parameters:
+
+        * text: The template text to compile
+        """
+        self.text = text
+        self.parts = []
+        position = 0
+        literal = []
+        for match in string.Template.pattern.finditer(text):
+            literal.append(text[position:match.start()])
+            position = match.end()
+            if match.group('escaped') is not None:
+                literal.append(match.group('escaped'))
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError(
+                    'Invalid placeholder in template text %r' % text)
+            self.parts.append((''.join(literal), name))
+            literal = []
+        literal.append(text[position:])
+        self.tail = ''.join(literal)
+
+    def render(self, variables):
+        """
+        Substitutes variables into the compiled string.
+
+        Parameters:
+
+        * variables: Mapping of placeholder name to value
+
+        Raises KeyError for a missing variable.
+        """
+        result = []
+        for literal, name in self.parts:
+            result.append(literal)
+            result.append(u'%s' % variables[name])
+        result.append(self.tail)
+        return u''.join(result)
+
+
+def _compile(value):
+    """
+    Compiles strings found in value. Strings without placeholders and
+    non-string values are returned untouched.
+    """
+    if isinstance(value, basestring):
+        compiled = CompiledString(value)
+        if compiled.parts:
+            return compiled
+        return compiled.tail
+    if isinstance(value, dict):
+        return dict((k, _compile(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_compile(v) for v in value]
+    return value
+
+
+def _render(value, variables):
+    """
+    Renders a value produced by _compile.
+    """
+    if isinstance(value, CompiledString):
+        return value.render(variables)
+    if isinstance(value, dict):
+        return dict((k, _render(v, variables)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_render(v, variables) for v in value]
+    return value
+
+
+class RequestTemplate(object):
+    """
+    A named request specification compiled at startup.
+    """
+
+    def __init__(self, name, spec):
+        """
+        Creates the template.
+
+        Parameters:
+
+        * name: The name messages reference the template by
+        * spec: Dictionary of request parameters which may hold placeholders
+        """
+        if not isinstance(spec, dict):
+            raise ValueError('Template %s must be a dictionary' % name)
+        self.name = name
+        self.subcommand = spec.get('subcommand')
+        self._spec = _compile(spec)
+
+    def render(self, variables):
+        """
+        Returns a new parameters dictionary with variables substituted.
+
+        Parameters:
+
+        * variables: Mapping of placeholder name to value
+
+        Raises KeyError for a missing variable.
+        """
+        return _render(self._spec, variables)
+
+
+def compile_templates(config):
+    """
+    Compiles the templates section of the worker configuration.
+
+    Parameters:
+
+    * config: Mapping of template name to request specification
+    """
+    return dict(
+        (name, RequestTemplate(name, spec)) for name, spec in config.items())
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Shared TLS contexts.
+
+One SSLContext is built per trust/client-cert combination and shared by
+every session using it, so CA bundles and client keys are loaded once
+instead of on every new connection. Where the ssl module supports it
+(Python 3.6+) TLS sessions are kept per server name and offered again
+on the next handshake so the server can resume them.
+"""
+
+import os
+import ssl
+import threading
+
+from requests import certs
+from requests.adapters import HTTPAdapter
+
+#: Whether the ssl module can offer a saved session on wrap_socket
+RESUMPTION_SUPPORTED = hasattr(ssl.SSLSocket, 'session')
+
+
+def build_context(verify=True, cert=None):
+    """
+    Creates an SSLContext with the trust and client cert settings loaded.
+
+    Parameters:
+
+    * verify: True for the default CA bundle, False to skip verification,
+      or a path to a CA bundle file or directory
+    * cert: Client certificate path or (cert, key) tuple, if any
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    # urllib3 does its own hostname matching
+    context.check_hostname = False
+    if verify is False:
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context.verify_mode = ssl.CERT_REQUIRED
+        if verify is True:
+            verify = certs.where()
+        if os.path.isdir(verify):
+            context.load_verify_locations(capath=verify)
+        else:
+            context.load_verify_locations(cafile=verify)
+    if cert:
+        if isinstance(cert, basestring):
+            context.load_cert_chain(cert)
+        else:
+            context.load_cert_chain(cert[0], cert[1])
+    return context
+
+
+class _ResumingContext(object):
+    """
+    Proxy around an SSLContext which counts handshakes and offers the
+    last session seen for a server name when it can.
+    """
+
+    def __init__(self, context, registry):
+        self.__dict__['_context'] = context
+        self.__dict__['_registry'] = registry
+        self.__dict__['_tls_sessions'] = {}
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._context, name, value)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        server_name = kwargs.get('server_hostname')
+        if RESUMPTION_SUPPORTED:
+            saved = self._tls_sessions.get(server_name)
+            if saved is not None:
+                kwargs['session'] = saved
+        tls_sock = self._context.wrap_socket(sock, *args, **kwargs)
+        resumed = getattr(tls_sock, 'session_reused', False)
+        self._registry.record_handshake(bool(resumed))
+        if RESUMPTION_SUPPORTED and tls_sock.session is not None:
+            self._tls_sessions[server_name] = tls_sock.session
+        return tls_sock
+
+
+class TLSContextRegistry(object):
+    """
+    Builds and caches one context per trust and client cert profile.
+    """
+
+    def __init__(self):
+        self._contexts = {}
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+    def context_for(self, verify=True, cert=None):
+        """
+        Returns the shared context for the given settings.
+
+        Parameters:
+
+        * verify: See build_context
+        * cert: See build_context
+        """
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        key = (verify, cert)
+        if key not in self._contexts:
+            self._contexts[key] = _ResumingContext(
+                build_context(verify, cert), self)
+        return self._contexts[key]
+
+    def record_handshake(self, resumed):
+        """
+        Counts a completed handshake.
+
+        Parameters:
+
+        * resumed: Whether the server resumed an earlier session
+        """
+        with self._lock:
+            self.handshakes += 1
+            if resumed:
+                self.resumed += 1
+
+    def stats(self):
+        """
+        Returns handshake counters for reporting. Resumption counters are
+        left out where the ssl module can not resume sessions.
+        """
+        stats = {
+            'tls_contexts': len(self._contexts),
+            'tls_handshakes': self.handshakes,
+        }
+        if RESUMPTION_SUPPORTED:
+            rate = 0.0
+            if self.handshakes:
+                rate = float(self.resumed) / self.handshakes
+            stats['tls_resumed'] = self.resumed
+            stats['tls_resumption_rate'] = round(rate, 3)
+        return stats
+
+
+class TLSContextAdapter(HTTPAdapter):
+    """
+    Transport adapter which hands a shared context to every pool.
+    """
+
+    def __init__(self, ssl_context, **kwargs):
+        # Must be set before HTTPAdapter builds the pool manager
+        self.ssl_context = ssl_context
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs['ssl_context'] = self.ssl_context
+        return HTTPAdapter.proxy_manager_for(self, proxy, **proxy_kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        # Trust and client certs are already in the shared context.
+        # Leaving ca_certs unset keeps urllib3 from reloading them on
+        # every new connection.
+        if not url.lower().startswith('https'):
+            return
+        if self.ssl_context.verify_mode == ssl.CERT_NONE:
+            conn.cert_reqs = 'CERT_NONE'
+        else:
+            conn.cert_reqs = 'CERT_REQUIRED'
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+        conn.cert_file = None
+        conn.key_file = None
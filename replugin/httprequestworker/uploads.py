@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Chunked uploads for large Put/Post bodies.
+
+Two protocols are supported:
+
+* ``s3``: S3 style multipart upload. Parts are uploaded in parallel and
+  each part's ETag is checked against its MD5. Passing the ``upload_id``
+  of an earlier attempt skips the parts the server already holds.
+* ``content-range``: resumable upload where each part is sent with a
+  ``Content-Range`` and ``Content-MD5`` header and the server answers
+  308 until the last part. The protocol needs parts in order, so they
+  are sent one at a time; after a failure the confirmed offset is asked
+  for with ``Content-Range: bytes */<total>`` and the upload carries on
+  from there.
+
+Put and Post messages select chunked mode with a ``chunked`` parameter
+and may name a local ``file`` under the worker's ``file_root`` instead
+of passing ``content``::
+
+    "chunked": {
+        "protocol": "s3",
+        "part_size": 8388608,
+        "parallel": 4,
+        "retries": 3,
+        "upload_id": "optional id of an upload to resume",
+        "resume": false
+    }
+
+``resume`` applies to ``content-range`` and asks the server for its
+offset before the first part is sent. ``"chunked": true`` uploads with
+the defaults shown while ``false`` or ``null`` send a normal request.
+A 308 which does not move the offset on counts as a failed attempt.
+``part_size``, ``parallel`` and ``retries`` must be
+positive integers.
+"""
+
+import base64
+import hashlib
+import os
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+import requests
+
+
+class UploadError(Exception):
+    """
+    Raised when a chunked upload can not be completed.
+    """
+    pass
+
+
+class PartSource(object):
+    """
+    Reads parts of an upload body from memory or from a local file.
+    """
+
+    def __init__(self, content=None, path=None):
+        """
+        Creates the source.
+
+        Parameters:
+
+        * content: The body as a string
+        * path: A local file holding the body, used instead of content
+        """
+        self._content = content
+        self._path = path
+        if path is not None:
+            self.size = os.path.getsize(path)
+        else:
+            self.size = len(content)
+
+    def read(self, offset, length):
+        """
+        Returns length bytes starting at offset.
+        """
+        if self._path is None:
+            return self._content[offset:offset + length]
+        with open(self._path, 'rb') as source_file:
+            source_file.seek(offset)
+            return source_file.read(length)
+
+
+def _children(root, tag):
+    """
+    Yields elements named tag under root, ignoring XML namespaces.
+    """
+    for element in root.iter():
+        if element.tag.split('}')[-1] == tag:
+            yield element
+
+
+def _child_text(root, tag):
+    """
+    Returns the text of the first element named tag under root, or None.
+    """
+    for element in _children(root, tag):
+        return element.text
+    return None
+
+
+class ChunkedUploader(object):
+    """
+    Uploads a PartSource in parts over a pooled session.
+    """
+
+    def __init__(self, session, url, source, content_type, headers=None,
+                 part_size=8 * 1024 * 1024, parallel=4, retries=3):
+        """
+        Creates the uploader.
+
+        Parameters:
+
+        * session: The session to send requests with
+        * url: The URL to upload to
+        * source: The PartSource to upload
+        * content_type: The content-type of the whole body
+        * headers: Extra headers to send with every request
+        * part_size: Size of each part in bytes
+        * parallel: How many parts to upload at once (s3 only)
+        * retries: Attempts per part before giving up
+        """
+        self.session = session
+        self.url = url
+        self.source = source
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.part_size = int(part_size)
+        self.parallel = max(1, int(parallel))
+        self.retries = max(1, int(retries))
+        self.upload_id = None
+
+    def parts(self):
+        """
+        Returns (number, offset, length) for every part. Numbers start at 1.
+        """
+        result = []
+        offset = 0
+        while offset < self.source.size:
+            length = min(self.part_size, self.source.size - offset)
+            result.append((len(result) + 1, offset, length))
+            offset += length
+        return result
+
+    # S3 style multipart
+    def upload_s3(self, upload_id=None):
+        """
+        Runs a multipart upload and returns the completion response.
+
+        Parameters:
+
+        * upload_id: The id of an earlier upload to resume, if any
+        """
+        confirmed = {}
+        if upload_id is None:
+            self.upload_id = self._s3_initiate()
+        else:
+            self.upload_id = upload_id
+            confirmed = self._s3_list_parts(upload_id)
+
+        etags = {}
+        pending = []
+        for number, offset, length in self.parts():
+            etag = confirmed.get(number)
+            if etag is not None and etag.strip('"') == hashlib.md5(
+                    self.source.read(offset, length)).hexdigest():
+                etags[number] = etag
+            else:
+                pending.append((number, offset, length))
+
+        pool = ThreadPool(self.parallel)
+        try:
+            for number, etag in pool.imap_unordered(
+                    self._s3_put_part, pending):
+                etags[number] = etag
+        finally:
+            pool.close()
+            pool.join()
+        return self._s3_complete(etags)
+
+    def _s3_initiate(self):
+        """
+        Starts a multipart upload and returns its id.
+        """
+        headers = dict(self.headers)
+        headers['content-type'] = self.content_type
+        response = self.session.post(
+            self.url, params={'uploads': ''}, headers=headers)
+        if response.status_code != 200:
+            raise UploadError(
+                'Starting multipart upload returned %s' % (
+                    response.status_code))
+        upload_id = _child_text(
+            ElementTree.fromstring(response.content), 'UploadId')
+        if not upload_id:
+            raise UploadError('No UploadId in multipart upload response')
+        return upload_id
+
+    def _s3_list_parts(self, upload_id):
+        """
+        Returns a mapping of part number to ETag the server holds.
+        """
+        confirmed = {}
+        params = {'uploadId': upload_id}
+        while True:
+            response = self.session.get(
+                self.url, params=params, headers=self.headers)
+            if response.status_code != 200:
+                raise UploadError(
+                    'Listing parts returned %s' % response.status_code)
+            root = ElementTree.fromstring(response.content)
+            for part in _children(root, 'Part'):
+                confirmed[int(_child_text(part, 'PartNumber'))] = (
+                    _child_text(part, 'ETag'))
+            if _child_text(root, 'IsTruncated') != 'true':
+                return confirmed
+            params['part-number-marker'] = _child_text(
+                root, 'NextPartNumberMarker')
+
+    def _s3_put_part(self, part):
+        """
+        Uploads one part, retrying on failure. Returns (number, etag).
+        """
+        number, offset, length = part
+        data = self.source.read(offset, length)
+        digest = hashlib.md5(data).hexdigest()
+        error = None
+        for attempt in range(self.retries):
+            try:
+                response = self.session.put(
+                    self.url,
+                    params={'partNumber': number, 'uploadId': self.upload_id},
+                    data=data,
+                    headers=self.headers)
+            except requests.ConnectionError, ce:
+                error = ce
+                continue
+            etag = response.headers.get('ETag', '')
+            if response.status_code != 200:
+                error = 'status %s' % response.status_code
+            elif etag.strip('"') != digest:
+                error = 'checksum mismatch'
+            else:
+                return number, etag
+        raise UploadError(
+            'Part %s failed after %s attempts: %s' % (
+                number, self.retries, error))
+
+    def _s3_complete(self, etags):
+        """
+        Completes the multipart upload and returns the response. Raises
+        UploadError unless the server answers 200.
+        """
+        body = ['<CompleteMultipartUpload>']
+        for number in sorted(etags):
+            body.append(
+                '<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % (
+                    number, etags[number]))
+        body.append('</CompleteMultipartUpload>')
+        response = self.session.post(
+            self.url,
+            params={'uploadId': self.upload_id},
+            data=''.join(body),
+            headers=self.headers)
+        if response.status_code != 200:
+            raise UploadError(
+                'Completing multipart upload returned %s' % (
+                    response.status_code))
+        return response
+
+    # Content-Range resumable uploads
+    def upload_content_range(self, resume=False):
+        """
+        Runs a resumable upload and returns the final response.
+
+        Parameters:
+
+        * resume: Whether to ask the server for its offset before starting
+        """
+        total = self.source.size
+        if total == 0:
+            raise UploadError('Nothing to upload')
+        offset = 0
+        if resume:
+            offset, response = self._confirmed_offset()
+            if response is not None:
+                return response
+
+        failures = 0
+        while True:
+            length = min(self.part_size, total - offset)
+            data = self.source.read(offset, length)
+            headers = dict(self.headers)
+            headers.update({
+                'content-type': self.content_type,
+                'Content-Range': 'bytes %s-%s/%s' % (
+                    offset, offset + length - 1, total),
+                'Content-MD5': base64.b64encode(hashlib.md5(data).digest()),
+            })
+            try:
+                response = self.session.put(
+                    self.url, data=data, headers=headers)
+                if response.status_code in (200, 201):
+                    return response
+                if response.status_code == 308:
+                    confirmed = self._range_end(response)
+                    if confirmed > offset:
+                        offset = confirmed
+                        failures = 0
+                        continue
+                    error = 'server confirmed only %s bytes' % confirmed
+                else:
+                    error = 'status %s' % response.status_code
+            except requests.ConnectionError, ce:
+                error = ce
+            failures += 1
+            if failures >= self.retries:
+                raise UploadError(
+                    'Upload stopped at byte %s of %s after %s attempts: %s' % (
+                        offset, total, failures, error))
+            offset, response = self._confirmed_offset()
+            if response is not None:
+                return response
+
+    def _confirmed_offset(self):
+        """
+        Asks the server how much it has. Returns (offset, None), or
+        (total, response) when the upload is already complete.
+        """
+        response = self.session.put(
+            self.url,
+            data='',
+            headers=dict(self.headers, **{
+                'Content-Range': 'bytes */%s' % self.source.size}))
+        if response.status_code in (200, 201):
+            return self.source.size, response
+        if response.status_code != 308:
+            raise UploadError(
+                'Upload status query returned %s' % response.status_code)
+        return self._range_end(response), None
+
+    def _range_end(self, response):
+        """
+        Returns the offset after the Range a 308 response confirms. No
+        Range header means the server holds nothing yet.
+        """
+        confirmed = response.headers.get('Range')
+        if not confirmed:
+            return 0
+        return int(confirmed.rsplit('-', 1)[1]) + 1
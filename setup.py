@@ -38,6 +38,8 @@ setup(
     entry_points={
         'console_scripts': [
             're-worker-httprequest = replugin.httprequestworker:main',
+            ('re-worker-httprequest-supervisor = '
+             'replugin.httprequestworker.supervisor:main'),
         ],
     }
 )
@@ -17,6 +17,14 @@ Unittests.
 """
 
 import os
+import hashlib
+import logging
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
 import pika
 import mock
 import requests
@@ -26,6 +34,16 @@ from contextlib import nested
 from . import TestCase
 
 from replugin import httprequestworker
+from replugin.httprequestworker import concurrency
+from replugin.httprequestworker import events
+from replugin.httprequestworker import hedging
+from replugin.httprequestworker import lanes
+from replugin.httprequestworker import profiling
+from replugin.httprequestworker import sessions
+from replugin.httprequestworker import supervisor
+from replugin.httprequestworker import templates
+from replugin.httprequestworker import tls
+from replugin.httprequestworker import uploads
 
 
 MQ_CONF = {
@@ -142,6 +160,16 @@ class TestHTTPRequestWorker(TestCase):
                 200,
                 {'code': 404})
 
+            # Mismatches are reported to the host's concurrency limit
+            worker._concurrency = mock.MagicMock()
+            self.assertRaises(
+                httprequestworker.HTTPRequestWorkerError,
+                worker._check_code,
+                404,
+                {'code': 200, 'url': 'http://127.0.0.1:8080/x'})
+            worker._concurrency.report_unexpected.assert_called_once_with(
+                '127.0.0.1:8080', 404)
+
     def test_request_get(self):
         """
         Verify request_get works as it should.
@@ -150,7 +178,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.get')) as (_, _, _, _get):
+                mock.patch('requests.Session.get')) as (_, _, _, _get):
 
             fake_response = requests.Response()
             fake_response.status_code = 200
@@ -181,7 +209,7 @@ class TestHTTPRequestWorker(TestCase):
                 body,
                 self.logger)
 
-            _get.assert_called_once_with('http://127.0.0.1')
+            _get.assert_called_once_with('http://127.0.0.1', headers={})
             assert self.app_logger.error.call_count == 0
             assert worker.send.call_args[0][2]['status'] == 'completed'
 
@@ -193,7 +221,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.get')) as (_, _, _, _get):
+                mock.patch('requests.Session.get')) as (_, _, _, _get):
 
             fake_response = requests.Response()
             fake_response.status_code = 400
@@ -224,7 +252,7 @@ class TestHTTPRequestWorker(TestCase):
                 body,
                 self.logger)
 
-            _get.assert_called_once_with('http://127.0.0.1')
+            _get.assert_called_once_with('http://127.0.0.1', headers={})
             assert self.app_logger.error.call_count == 1
             assert worker.send.call_args[0][2]['status'] == 'failed'
 
@@ -242,7 +270,7 @@ class TestHTTPRequestWorker(TestCase):
                 body,
                 self.logger)
 
-            _get.assert_called_once_with('http://127.0.0.1')
+            _get.assert_called_once_with('http://127.0.0.1', headers={})
             assert self.app_logger.error.call_count == 1
             assert worker.send.call_args[0][2]['status'] == 'failed'
 
@@ -254,7 +282,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.delete')) as (_, _, _, _delete):
+                mock.patch('requests.Session.delete')) as (_, _, _, _delete):
 
             fake_response = requests.Response()
             fake_response.status_code = 410
@@ -285,7 +313,7 @@ class TestHTTPRequestWorker(TestCase):
                 body,
                 self.logger)
 
-            _delete.assert_called_once_with('http://127.0.0.1')
+            _delete.assert_called_once_with('http://127.0.0.1', headers={})
             assert self.app_logger.error.call_count == 0
             assert worker.send.call_args[0][2]['status'] == 'completed'
 
@@ -297,7 +325,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.delete')) as (_, _, _, _delete):
+                mock.patch('requests.Session.delete')) as (_, _, _, _delete):
 
             fake_response = requests.Response()
             fake_response.status_code = 400
@@ -328,7 +356,7 @@ class TestHTTPRequestWorker(TestCase):
                 body,
                 self.logger)
 
-            _delete.assert_called_once_with('http://127.0.0.1')
+            _delete.assert_called_once_with('http://127.0.0.1', headers={})
             assert self.app_logger.error.call_count == 1
             assert worker.send.call_args[0][2]['status'] == 'failed'
 
@@ -346,7 +374,7 @@ class TestHTTPRequestWorker(TestCase):
                 body,
                 self.logger)
 
-            _delete.assert_called_once_with('http://127.0.0.1')
+            _delete.assert_called_once_with('http://127.0.0.1', headers={})
             assert self.app_logger.error.call_count == 1
             assert worker.send.call_args[0][2]['status'] == 'failed'
 
@@ -358,7 +386,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.put')) as (_, _, _, _put):
+                mock.patch('requests.Session.put')) as (_, _, _, _put):
 
             fake_response = requests.Response()
             fake_response.status_code = 201
@@ -406,7 +434,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.put')) as (_, _, _, _put):
+                mock.patch('requests.Session.put')) as (_, _, _, _put):
 
             fake_response = requests.Response()
             fake_response.status_code = 400
@@ -477,7 +505,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.post')) as (_, _, _, _post):
+                mock.patch('requests.Session.post')) as (_, _, _, _post):
 
             fake_response = requests.Response()
             fake_response.status_code = 200
@@ -525,7 +553,7 @@ class TestHTTPRequestWorker(TestCase):
                 mock.patch('pika.SelectConnection'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
                 mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
-                mock.patch('requests.post')) as (_, _, _, _post):
+                mock.patch('requests.Session.post')) as (_, _, _, _post):
 
             fake_response = requests.Response()
             fake_response.status_code = 400
@@ -587,3 +615,1108 @@ class TestHTTPRequestWorker(TestCase):
 
             assert self.app_logger.error.call_count == 1
             assert worker.send.call_args[0][2]['status'] == 'failed'
+
+    def test_request_template(self):
+        """
+        Verify templates are expanded and message parameters win.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
+                mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
+                mock.patch('requests.Session.get')) as (_, _, _, _get):
+
+            fake_response = requests.Response()
+            fake_response.status_code = 204
+            _get.return_value = fake_response
+
+            worker = httprequestworker.HTTPRequestWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._templates = templates.compile_templates({
+                'status': {
+                    'subcommand': 'Get',
+                    'url': 'http://${host}/status',
+                    'headers': {'X-Release': '$version', 'X-Cost': '$$5'},
+                    'code': 200,
+                },
+            })
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                "parameters": {
+                    "command": "httprequest",
+                    "template": "status",
+                    "variables": {"host": "127.0.0.1", "version": 2},
+                    "code": 204,
+                },
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            _get.assert_called_once_with(
+                'http://127.0.0.1/status',
+                headers={'X-Release': '2', 'X-Cost': '$5'})
+            assert self.app_logger.error.call_count == 0
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+
+            # Missing or malformed variables and unknown templates fail
+            # the message
+            for params in (
+                    {'template': 'status', 'variables': {'host': 'x'}},
+                    {'template': 'status', 'variables': ['x']},
+                    {'template': 'nope'}):
+                self.app_logger.error.reset_mock()
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    {'parameters': params},
+                    self.logger)
+                assert self.app_logger.error.call_count == 1
+                assert worker.send.call_args[0][2]['status'] == 'failed'
+
+    def test_compile_templates_invalid(self):
+        """
+        Verify invalid templates are rejected when compiled.
+        """
+        self.assertRaises(
+            ValueError, templates.compile_templates, {'bad': {'url': 'a$'}})
+        self.assertRaises(
+            ValueError, templates.compile_templates, {'bad': 'Get'})
+
+    def test_session_pool_profiles(self):
+        """
+        Verify host profiles are applied to their pooled sessions.
+        """
+        config_dir = tempfile.mkdtemp()
+        ca, cert, key = [
+            os.path.join(config_dir, name) for name in ('ca', 'cert', 'key')]
+        for path in (ca, cert, key):
+            open(path, 'w').close()
+        try:
+            with mock.patch(
+                    'replugin.httprequestworker.tls.build_context') as _build:
+                _build.side_effect = lambda verify, cert: mock.MagicMock(
+                    verify=verify, cert=cert)
+                pool = sessions.SessionPool({
+                    'api.example.com': {
+                        'headers': {'Accept': 'application/json'},
+                        'auth': {'type': 'basic', 'username': 'u', 'password': 'p'},
+                        'verify': ca,
+                        'proxies': {'https': 'http://proxy:3128'},
+                    },
+                    'api.example.com:8443': {
+                        'auth': {'type': 'bearer', 'token': 'abc'},
+                        'verify': False,
+                    },
+                    'cert.example.com': {
+                        'auth': {'type': 'cert', 'cert': cert, 'key': key},
+                    },
+                })
+        finally:
+            shutil.rmtree(config_dir)
+
+        session = pool.session_for('https://api.example.com/v1')
+        assert session.headers['Accept'] == 'application/json'
+        assert session.auth == ('u', 'p')
+        assert session.verify is True
+        assert session.proxies['https'] == 'http://proxy:3128'
+        context = session.get_adapter('https://api.example.com').ssl_context
+        assert context.verify == ca
+        # The same session is handed out for every request to the host
+        assert pool.session_for('https://api.example.com/v2') is session
+
+        session = pool.session_for('https://api.example.com:8443/')
+        assert session.headers['Authorization'] == 'Bearer abc'
+        assert session.verify is False
+
+        session = pool.session_for('https://cert.example.com/')
+        context = session.get_adapter('https://cert.example.com').ssl_context
+        assert context.cert == (cert, key)
+
+        # Unknown hosts share the default session and trust profile
+        default = pool.session_for('http://127.0.0.1/')
+        assert default is pool.session_for('http://localhost:8080/')
+        assert 'Authorization' not in default.headers
+        # default, custom CA, no verify and client cert profiles
+        assert _build.call_count == 4
+
+        for auth in ({'type': 'digest'},
+                     {'type': 'basic', 'password': 'p'},
+                     {'type': 'basic', 'username': 'u'},
+                     {'type': 'bearer'},
+                     {'type': 'bearer', 'token_file': '/nonexistent'},
+                     {'type': 'cert', 'key': '/tmp/k'}):
+            try:
+                sessions.SessionPool({'bad.example.com': {'auth': auth}})
+            except ValueError, ve:
+                assert 'bad.example.com' in str(ve)
+            else:
+                self.fail('Accepted invalid auth %s' % auth)
+
+    def test_hosts_config_errors(self):
+        """
+        Verify bad host profiles fail at startup and build errors fail
+        only the message.
+        """
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'worker.json')
+        with open(config_file, 'w') as config:
+            config.write(
+                '{"queue": "httprequest", "hosts": '
+                '{"a.example": {"auth": {"type": "bogus"}}}}')
+        try:
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
+                    mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
+                    mock.patch('replugin.httprequestworker.sessions.SessionPool')) as (_, _, _, _pool):
+                self.assertRaises(
+                    httprequestworker.HTTPRequestWorkerError,
+                    httprequestworker.HTTPRequestWorker,
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file=config_file)
+
+                worker = httprequestworker.HTTPRequestWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file='conf/example.json')
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+                _pool.side_effect = IOError('No such file')
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    {'parameters': {'subcommand': 'Get',
+                                    'url': 'http://127.0.0.1'}},
+                    self.logger)
+                assert worker.send.call_args[0][2]['status'] == 'failed'
+                assert worker._sessions is None
+        finally:
+            shutil.rmtree(config_dir)
+
+    def test_tls_context_registry(self):
+        """
+        Verify contexts are shared per profile and handshakes are counted.
+        """
+        registry = tls.TLSContextRegistry()
+        context = registry.context_for()
+        assert registry.context_for(True, None) is context
+        assert registry.context_for(False) is not context
+
+        tls_sock = mock.MagicMock(session_reused=True)
+        with mock.patch(
+                'ssl.SSLContext.wrap_socket', return_value=tls_sock):
+            assert context.wrap_socket(
+                mock.MagicMock(), server_hostname='a') is tls_sock
+        registry.record_handshake(False)
+
+        with mock.patch(
+                'replugin.httprequestworker.tls.RESUMPTION_SUPPORTED', True):
+            stats = registry.stats()
+        assert stats['tls_contexts'] == 2
+        assert stats['tls_handshakes'] == 2
+        assert stats['tls_resumed'] == 1
+        assert stats['tls_resumption_rate'] == 0.5
+
+        # Without resumption support the resumption counters are left out
+        with mock.patch(
+                'replugin.httprequestworker.tls.RESUMPTION_SUPPORTED', False):
+            assert registry.stats() == {
+                'tls_contexts': 2, 'tls_handshakes': 2}
+
+    def test_prewarm(self):
+        """
+        Verify the transport is built lazily and prewarm opens connections.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.httprequestworker.Worker.run_forever'),
+                mock.patch('requests.Session.head')) as (_, _run, _head):
+
+            worker = httprequestworker.HTTPRequestWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            assert worker._sessions is None
+            assert 'tls_handshakes' not in worker.stats()
+
+            fake_response = requests.Response()
+            fake_response.status_code = 200
+            worker._prewarm = ['http://127.0.0.1/', 'http://127.0.0.2/']
+            _head.side_effect = [fake_response, requests.ConnectionError]
+            worker.run_forever()
+
+            assert _head.call_count == 2
+            assert self.app_logger.warn.call_count == 1
+            assert worker._sessions is not None
+            assert 'startup_seconds' in worker.stats()
+            _run.assert_called_once_with(worker)
+
+    def test_preload_and_drain(self):
+        """
+        Verify preloaded state is reused and SIGTERM drains the worker.
+        """
+        try:
+            httprequestworker.preload({'queue': 'httprequest'})
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.httprequestworker.HTTPRequestWorker._process_message')):
+                worker = httprequestworker.HTTPRequestWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file='conf/example.json')
+                assert worker._sessions is httprequestworker._preloaded[
+                    httprequestworker._preload_key('hosts', {})]
+
+                # Idle workers exit right away
+                self.assertRaises(SystemExit, worker.drain)
+
+                # Busy workers finish the message first
+                worker._draining = False
+                worker._in_flight = True
+                worker.drain()
+                self.assertRaises(
+                    SystemExit, worker.process, self.channel,
+                    self.basic_deliver, self.properties, {}, self.logger)
+                assert worker._process_message.call_count == 1
+                assert worker._in_flight is False
+        finally:
+            httprequestworker._preloaded.clear()
+
+    def test_signals_do_not_interrupt_requests(self):
+        """
+        Verify SIGTERM and SIGUSR2 do not break a blocking read in flight.
+        """
+        ours, theirs = socket.socketpair()
+        received = []
+
+        def serve(worker):
+            worker._in_flight = True
+            threading.Timer(
+                0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+            threading.Timer(
+                0.2, os.kill, (os.getpid(), signal.SIGUSR2)).start()
+            threading.Timer(0.3, theirs.send, ('x',)).start()
+            received.append(ours.recv(1))
+
+        try:
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.httprequestworker.Worker.run_forever')) as (_, _run):
+                _run.side_effect = serve
+                worker = httprequestworker.HTTPRequestWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file='conf/example.json')
+                worker.run_forever()
+                assert received == ['x']
+                assert worker._draining is True
+                assert worker._profiler.enabled is True
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+            ours.close()
+            theirs.close()
+
+    def test_supervisor_restarts(self):
+        """
+        Verify the supervisor replaces dead children until stopped.
+        """
+        with nested(
+                mock.patch('os.fork'),
+                mock.patch('os.kill'),
+                mock.patch('time.sleep')) as (_fork, _kill, _sleep):
+            _fork.side_effect = [101, 102, 103]
+            sup = supervisor.Supervisor(
+                mock.MagicMock(), ['main/0', 'main/1'], self.app_logger)
+            sup.spawn('main/0')
+            sup.spawn('main/1')
+            assert sup.children == {101: 'main/0', 102: 'main/1'}
+
+            # A crashed child is replaced in its slot
+            sup.reap(101, 256)
+            assert sup.children == {102: 'main/1', 103: 'main/0'}
+
+            # Once stopping children are signalled and not replaced
+            sup.stop()
+            assert _kill.call_count == 2
+            sup.reap(102, 0)
+            sup.reap(103, 0)
+            assert sup.children == {}
+            assert _fork.call_count == 3
+
+            # A stop during the restart delay prevents the restart
+            sup.stopping = False
+            sup.children = {104: 'main/0'}
+            _sleep.side_effect = lambda delay: sup.stop()
+            sup.reap(104, 256)
+            assert sup.children == {}
+            assert _fork.call_count == 3
+
+    def test_lanes(self):
+        """
+        Verify messages are forwarded to the first matching lane.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
+                mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
+                mock.patch('replugin.httprequestworker.HTTPRequestWorker.ack'),
+                mock.patch('requests.Session.put')) as (_, _, _, _ack, _put):
+
+            fake_response = requests.Response()
+            fake_response.status_code = 200
+            _put.return_value = fake_response
+
+            worker = httprequestworker.HTTPRequestWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._lanes = lanes.load_lanes([
+                {'name': 'checks', 'queue': 'httprequest.checks',
+                 'subcommands': ['Get'], 'max_content_bytes': 0},
+                {'name': 'bulk', 'queue': 'httprequest.bulk',
+                 'min_content_bytes': 10},
+            ], 'httprequest')
+
+            # Every lane but bulk has a consumer
+            def queue_declare(callback, queue, **kwargs):
+                callback(mock.MagicMock(**{
+                    'method.consumer_count': int(queue != 'httprequest.bulk')}))
+            self.channel.queue_declare = mock.Mock(
+                'queue_declare', side_effect=queue_declare)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            # Lane queues exist before anything is forwarded to them
+            assert [c[1]['queue'] for c in
+                    self.channel.queue_declare.call_args_list[-3:]] == [
+                'httprequest.checks', 'httprequest.bulk',
+                'httprequest.default']
+            assert worker._lane_consumers == {
+                'checks': 1, 'bulk': 0, 'default': 1}
+            assert self.app_logger.warn.call_count == 1
+
+            body = {
+                "parameters": {
+                    "command": "httprequest",
+                    "subcommand": "Get",
+                    "url": "http://127.0.0.1",
+                },
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert self.channel.basic_publish.call_args[1][
+                'routing_key'] == 'httprequest.checks'
+            assert worker.send.call_count == 0
+
+            # Nothing matched so the message goes to the default lane
+            body['parameters'].update({
+                'subcommand': 'Put',
+                'contenttype': 'text/plain',
+                'content': 'small'})
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert self.channel.basic_publish.call_args[1][
+                'routing_key'] == 'httprequest.default'
+            assert worker.send.call_count == 0
+
+            # bulk has no consumers so its messages are handled here
+            body['parameters']['content'] = 'x' * 20
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert self.channel.basic_publish.call_count == 2
+            assert worker.send.call_args[0][2]['status'] == 'completed'
+            assert _ack.call_count == 3
+
+            # Lanes are checked again after LANE_CHECK_INTERVAL
+            worker._lanes_checked -= httprequestworker.LANE_CHECK_INTERVAL + 1
+            self.channel.queue_declare.side_effect = (
+                lambda callback, queue, **kwargs: callback(
+                    mock.MagicMock(**{'method.consumer_count': 1})))
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert self.channel.basic_publish.call_args[1][
+                'routing_key'] == 'httprequest.bulk'
+
+            # Lane workers handle whatever they receive
+            worker._lane = worker._lanes[1]
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            assert self.channel.basic_publish.call_count == 3
+            assert _put.call_count == 2
+
+        self.assertRaises(ValueError, lanes.load_lanes, [{'name': 'x'}])
+        # No default lane is added without lanes or when one is configured
+        assert lanes.load_lanes([], 'httprequest') == []
+        assert [lane.queue for lane in lanes.load_lanes(
+            [{'name': 'default', 'queue': 'q'}], 'httprequest')] == ['q']
+
+    def test_event_logger(self):
+        """
+        Verify events are sampled per type and formatted lazily.
+        """
+        logger = mock.MagicMock()
+        logger.isEnabledFor.return_value = True
+        event_logger = events.EventLogger(
+            logger, {'http.response': 0.25, 'noisy': 0})
+
+        for _ in range(8):
+            event_logger.event('http.response', status=200)
+            event_logger.event('noisy')
+        event_logger.event('message.completed', subcommand='Get')
+
+        assert logger.log.call_count == 3
+        level, fmt, name, fields = logger.log.call_args_list[0][0]
+        assert name == 'http.response'
+        assert str(fields) == 'sample=4 status=200'
+        assert str(logger.log.call_args[0][3]) == 'subcommand=Get'
+
+        # Nothing is done for disabled levels
+        logger.reset_mock()
+        logger.isEnabledFor.return_value = False
+        event_logger.event('message.completed', subcommand='Get')
+        assert logger.log.call_count == 0
+
+    def test_buffered_async_handler(self):
+        """
+        Verify the async handler hands records on and drops when full.
+        """
+        target = mock.MagicMock(level=0)
+        handler = events.BufferedAsyncHandler(target, capacity=1)
+        record = logging.LogRecord('x', logging.INFO, 'f', 1, 'msg', (), None)
+        handler.emit(record)
+        handler.flush()
+        target.handle.assert_called_once_with(record)
+
+        # Block the target so the queue fills up
+        release = threading.Event()
+        target.handle.side_effect = lambda record: release.wait()
+        try:
+            handler.emit(record)
+            for _ in range(100):
+                if target.handle.call_count == 2:
+                    break
+                time.sleep(0.01)
+            handler.emit(record)
+            handler.emit(record)
+            assert handler.dropped == 1
+
+            # A stuck target does not hang flush
+            started = time.time()
+            handler.flush(timeout=0.1)
+            assert time.time() - started < 1
+        finally:
+            release.set()
+            handler.close()
+        assert not handler._thread.is_alive()
+        assert target.handle.call_count == 3
+
+    def test_message_profiler(self):
+        """
+        Verify only sampled calls are profiled and aggregates are written.
+        """
+        output_dir = tempfile.mkdtemp()
+        try:
+            profiler = profiling.MessageProfiler(
+                sample_every=2, dump_every=2, output_dir=output_dir)
+            func = mock.MagicMock(return_value='result')
+
+            # Disabled profilers just make the call
+            assert profiler.call(func, 1, a=2) == 'result'
+            func.assert_called_once_with(1, a=2)
+            assert profiler._seen == 0
+
+            profiler.toggle()
+            for _ in range(3):
+                assert profiler.call(func) == 'result'
+            assert profiler._profiled == 1
+            assert os.listdir(output_dir) == []
+
+            for _ in range(2):
+                profiler.call(func)
+            files = os.listdir(output_dir)
+            assert len(files) == 1
+            assert files[0].endswith('.pstats')
+            assert profiler.dump() is None
+
+            # Objects still held after a message are counted per type
+            class Holder(object):
+                pass
+
+            held = []
+            profiler = profiling.MessageProfiler(
+                enabled=True, sample_every=1, dump_every=1,
+                output_dir=os.path.join(output_dir, 'alloc'),
+                trace_allocations=True)
+            profiler.call(
+                lambda: held.extend(Holder() for _ in range(50)))
+            path = os.listdir(os.path.join(output_dir, 'alloc'))
+            assert sorted(name.rsplit('.', 1)[1] for name in path) == [
+                'alloc', 'pstats']
+            alloc = [name for name in path if name.endswith('.alloc')][0]
+            with open(os.path.join(output_dir, 'alloc', alloc)) as alloc_file:
+                lines = alloc_file.read().splitlines()
+            assert lines[0].startswith('rss_growth=')
+            assert 'Holder objects=+50' in lines
+            assert profiler._allocations == {}
+
+            # Write errors are logged instead of failing the call
+            profiler = profiling.MessageProfiler(
+                enabled=True, sample_every=1, dump_every=1,
+                output_dir=os.path.join(output_dir, files[0]),
+                trace_allocations=True, logger=self.app_logger)
+            assert profiler.call(func) == 'result'
+            assert self.app_logger.error.call_count == 1
+            assert profiler._stats is None
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_chunked_upload_s3(self):
+        """
+        Verify multipart uploads check ETags and skip confirmed parts.
+        """
+        def response(status, content='', headers=None):
+            fake_response = requests.Response()
+            fake_response.status_code = status
+            fake_response._content = content
+            fake_response.headers.update(headers or {})
+            return fake_response
+
+        def etag(data):
+            return '"%s"' % hashlib.md5(data).hexdigest()
+
+        session = mock.MagicMock()
+        session.post.side_effect = [
+            response(200, '<InitiateMultipartUploadResult xmlns="x">'
+                          '<UploadId>up1</UploadId>'
+                          '</InitiateMultipartUploadResult>'),
+            response(200)]
+        # Part 2 first comes back corrupted and is retried
+        corrupted = []
+
+        def put(url, params, data, headers):
+            if params['partNumber'] == 2 and not corrupted:
+                corrupted.append(data)
+                return response(200, headers={'ETag': '"bad"'})
+            return response(200, headers={'ETag': etag(data)})
+
+        session.put.side_effect = put
+        uploader = uploads.ChunkedUploader(
+            session, 'http://127.0.0.1/obj', uploads.PartSource('abcdefg'),
+            'text/plain', part_size=3, parallel=2)
+        assert uploader.upload_s3().status_code == 200
+        assert session.put.call_count == 4
+        complete = session.post.call_args
+        assert complete[1]['params'] == {'uploadId': 'up1'}
+        assert complete[1]['data'].count('<Part>') == 3
+        assert etag('abc') in complete[1]['data']
+
+        # Resuming only sends parts the server does not hold
+        session.reset_mock()
+        session.get.return_value = response(
+            200, '<ListPartsResult><IsTruncated>false</IsTruncated>'
+                 '<Part><PartNumber>1</PartNumber><ETag>%s</ETag></Part>'
+                 '<Part><PartNumber>2</PartNumber><ETag>"bad"</ETag></Part>'
+                 '</ListPartsResult>' % etag('abc'))
+        session.post.side_effect = None
+        session.post.return_value = response(200)
+        uploader.upload_s3('up1')
+        assert session.put.call_count == 2
+
+        # A failed completion raises instead of returning the response
+        session.post.return_value = response(500)
+        self.assertRaises(uploads.UploadError, uploader.upload_s3, 'up1')
+
+        # Parts failing every checksum stop the upload
+        session.put.side_effect = None
+        session.put.return_value = response(200, headers={'ETag': '"x"'})
+        self.assertRaises(uploads.UploadError, uploader.upload_s3, 'up1')
+        assert uploader.upload_id == 'up1'
+
+    def test_chunked_upload_options(self):
+        """
+        Verify chunked options are validated before uploading.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.httprequestworker.uploads.ChunkedUploader')) as (_, _uploader):
+            worker = httprequestworker.HTTPRequestWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            params = {
+                'url': 'http://127.0.0.1/obj',
+                'contenttype': 'text/plain',
+                'content': 'abc',
+                'chunked': True,
+            }
+
+            # true uses the defaults
+            worker._chunked_upload(params)
+            assert _uploader.call_args[1]['part_size'] == 8 * 1024 * 1024
+            assert _uploader.call_args[1]['parallel'] == 4
+            _uploader.return_value.upload_s3.assert_called_once_with(None)
+
+            for chunked in ('yes', {'part_size': 0}, {'parallel': '2'},
+                            {'retries': True}, {'part_size': 1.5}):
+                params['chunked'] = chunked
+                self.assertRaises(
+                    httprequestworker.HTTPRequestWorkerError,
+                    worker._chunked_upload, params)
+            assert _uploader.call_count == 1
+
+            # Failures name the upload so it can be resumed
+            _uploader.return_value.upload_id = 'up1'
+            _uploader.return_value.upload_s3.side_effect = (
+                uploads.UploadError('Part 2 failed'))
+            params['chunked'] = True
+            try:
+                worker._chunked_upload(params)
+                self.fail('Expected HTTPRequestWorkerError')
+            except httprequestworker.HTTPRequestWorkerError, error:
+                assert 'Resume with upload_id up1' in str(error)
+
+            # false and null send a normal request
+            with mock.patch(
+                    'replugin.httprequestworker.HTTPRequestWorker._send') as _send:
+                _send.return_value.status_code = 200
+                for chunked in (False, None):
+                    params['chunked'] = chunked
+                    worker.request_put({'parameters': params}, 1, None)
+                assert _send.call_count == 2
+            assert _uploader.call_count == 2
+
+    def test_local_files(self):
+        """
+        Verify local files must be inside the configured file_root.
+        """
+        with mock.patch('pika.SelectConnection'):
+            worker = httprequestworker.HTTPRequestWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+        root = tempfile.mkdtemp()
+        try:
+            params = {'file': os.path.join(root, 'body')}
+            self.assertRaises(
+                httprequestworker.HTTPRequestWorkerError,
+                worker._local_path, params, 'file')
+
+            worker._config['file_root'] = root + '/'
+            root = os.path.realpath(root)
+            assert worker._local_path(params, 'file') == os.path.join(
+                root, 'body')
+            params['file'] = 'sub/body'
+            assert worker._local_path(params, 'file') == os.path.join(
+                root, 'sub', 'body')
+            os.symlink('/etc', os.path.join(root, 'link'))
+            for path in ('/etc/passwd', '../body', root, root + '-x/body',
+                         'link/passwd', 5):
+                params['file'] = path
+                self.assertRaises(
+                    httprequestworker.HTTPRequestWorkerError,
+                    worker._local_path, params, 'file')
+        finally:
+            shutil.rmtree(root)
+
+    def test_chunked_upload_content_range(self):
+        """
+        Verify resumable uploads carry on from the confirmed offset.
+        """
+        def response(status, headers=None):
+            fake_response = requests.Response()
+            fake_response.status_code = status
+            fake_response.headers.update(headers or {})
+            return fake_response
+
+        session = mock.MagicMock()
+        session.put.side_effect = [
+            response(308, {'Range': 'bytes=0-3'}),
+            requests.ConnectionError(),
+            # Status query after the failure
+            response(308, {'Range': 'bytes=0-3'}),
+            response(201),
+        ]
+        uploader = uploads.ChunkedUploader(
+            session, 'http://127.0.0.1/obj', uploads.PartSource('abcdefg'),
+            'text/plain', part_size=4)
+        assert uploader.upload_content_range().status_code == 201
+
+        ranges = [c[1]['headers']['Content-Range']
+                  for c in session.put.call_args_list]
+        assert ranges == [
+            'bytes 0-3/7', 'bytes 4-6/7', 'bytes */7', 'bytes 4-6/7']
+
+        # A server which never takes more bytes runs out of retries
+        session.reset_mock()
+        session.put.side_effect = None
+        session.put.return_value = response(308, {'Range': 'bytes=0-3'})
+        self.assertRaises(uploads.UploadError, uploader.upload_content_range)
+        # The first part, then a send and status query per failure
+        assert session.put.call_count == 6
+
+    def test_request_download(self):
+        """
+        Verify request_download fetches ranged segments into the path.
+        """
+        def response(status, content, headers=None):
+            fake_response = requests.Response()
+            fake_response.status_code = status
+            fake_response._content = content
+            fake_response._content_consumed = True
+            fake_response.headers.update(headers or {})
+            return fake_response
+
+        data = 'abcdefghij'
+
+        def get(url, headers, stream):
+            if 'Range' not in headers:
+                return response(200, data, {
+                    'Content-Length': str(len(data)),
+                    'Accept-Ranges': 'bytes',
+                    'ETag': '"v1"'})
+            start, end = headers['Range'][len('bytes='):].split('-')
+            return response(206, data[int(start):int(end) + 1])
+
+        output_dir = tempfile.mkdtemp()
+        try:
+            with nested(
+                    mock.patch('pika.SelectConnection'),
+                    mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
+                    mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
+                    mock.patch('requests.Session.get')) as (_, _, _, _get):
+                _get.side_effect = get
+
+                worker = httprequestworker.HTTPRequestWorker(
+                    MQ_CONF,
+                    logger=self.app_logger,
+                    config_file='conf/example.json')
+
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+
+                path = os.path.join(output_dir, 'artifact')
+                body = {
+                    "parameters": {
+                        "command": "httprequest",
+                        "subcommand": "Download",
+                        "url": "http://127.0.0.1/artifact",
+                        "path": '../' + os.path.basename(output_dir),
+                        "segment_size": 3,
+                        "checksum": "md5:%s" % hashlib.md5(data).hexdigest(),
+                    },
+                }
+
+                # Paths outside file_root are refused before fetching
+                worker._config['file_root'] = output_dir
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                assert worker.send.call_args[0][2]['status'] == 'failed'
+                assert _get.call_count == 0
+                self.app_logger.error.reset_mock()
+
+                # Execute the call
+                body['parameters']['path'] = 'artifact'
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+
+                assert self.app_logger.error.call_count == 0
+                assert worker.send.call_args[0][2]['status'] == 'completed'
+                # One probe and four segments
+                assert _get.call_count == 5
+                assert open(path, 'rb').read() == data
+                assert os.listdir(output_dir) == ['artifact']
+
+                # A bad checksum fails and leaves nothing behind
+                os.remove(path)
+                body['parameters']['checksum'] = 'md5:0'
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                assert self.app_logger.error.call_count == 1
+                assert worker.send.call_args[0][2]['status'] == 'failed'
+                assert os.listdir(output_dir) == []
+
+                # Malformed checksums fail before anything is fetched
+                for checksum in ('sha256', 'bogus:00'):
+                    body['parameters']['checksum'] = checksum
+                    worker.process(
+                        self.channel,
+                        self.basic_deliver,
+                        self.properties,
+                        body,
+                        self.logger)
+                    assert worker.send.call_args[0][2]['status'] == 'failed'
+                assert _get.call_count == 10
+                assert os.listdir(output_dir) == []
+
+                # A broken stream leaves nothing behind
+                del body['parameters']['checksum']
+                broken = mock.MagicMock(status_code=200, headers={})
+                broken.iter_content.side_effect = requests.ConnectionError
+                _get.side_effect = None
+                _get.return_value = broken
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+                assert worker.send.call_args[0][2]['status'] == 'failed'
+                assert os.listdir(output_dir) == []
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_adaptive_limit(self):
+        """
+        Verify limits grow while healthy and back off on congestion.
+        """
+        limit = concurrency.AdaptiveLimit(initial=2, minimum=1, maximum=3)
+        limit.acquire()
+        limit.acquire()
+        assert limit.in_flight == 2
+        limit.release(0.1)
+        limit.release(0.1)
+        assert 2 < limit.limit < 3
+
+        for _ in range(10):
+            limit.acquire()
+            limit.release(0.1)
+        assert limit.limit == 3
+
+        # Errors and slow responses shrink the limit
+        limit.acquire()
+        limit.release(0.1, failed=True)
+        assert limit.limit == 2.25
+        limit.acquire()
+        limit.release(5.0)
+        assert limit.limit < 2.25
+        for _ in range(10):
+            limit.acquire()
+            limit.release(0.1, failed=True)
+        assert limit.limit == 1
+        assert limit.in_flight == 0
+
+        # Large transfers are timed per transfer_bytes against their own
+        # baseline so they do not look like slow small requests
+        limit = concurrency.AdaptiveLimit(initial=2, transfer_bytes=100)
+        limit.acquire()
+        limit.release(0.1)
+        for _ in range(5):
+            limit.acquire()
+            limit.release(5.0, size=10000)
+        assert limit.limit > 2
+        assert limit.baseline == {'request': 0.1, 'transfer': 0.05}
+
+    def test_limited_session(self):
+        """
+        Verify limited sessions report outcomes to their host's limit.
+        """
+        controller = concurrency.ConcurrencyController(initial=4)
+        session = mock.MagicMock()
+        fake_response = requests.Response()
+        fake_response.status_code = 503
+        session.get.return_value = fake_response
+
+        limited = controller.wrap('127.0.0.1', session)
+        assert limited.get('http://127.0.0.1/') is fake_response
+        assert controller.limit_for('127.0.0.1').limit == 3
+
+        session.put.side_effect = requests.ConnectionError
+        self.assertRaises(
+            requests.ConnectionError, limited.put, 'http://127.0.0.1/')
+        assert controller.limit_for('127.0.0.1').in_flight == 0
+        assert controller.stats() == {'concurrency_limit:127.0.0.1': 2}
+        # Other attributes are passed through
+        assert limited.headers is session.headers
+
+        # Streamed responses hold the slot until read or closed
+        def streamed():
+            fake_response = requests.Response()
+            fake_response.status_code = 200
+            fake_response._content = 'x' * 100
+            fake_response._content_consumed = True
+            return fake_response
+        limit = controller.limit_for('127.0.0.1')
+        session.get.return_value = streamed()
+        response = limited.get('http://127.0.0.1/', stream=True)
+        assert limit.in_flight == 1
+        assert ''.join(response.iter_content(10)) == 'x' * 100
+        assert limit.in_flight == 0
+        response.close()
+        assert limit.in_flight == 0
+
+        session.get.return_value = streamed()
+        limited.get('http://127.0.0.1/', stream=True).close()
+        assert limit.in_flight == 0
+
+        # Unexpected statuses back off unless already counted as overload
+        limit.limit = 8.0
+        controller.report_unexpected('127.0.0.1', 404)
+        assert limit.limit == 6
+        controller.report_unexpected('127.0.0.1', 503)
+        assert limit.limit == 6
+
+        # Reserved slots are used by the next request, never waited for
+        controller = concurrency.ConcurrencyController(initial=1)
+        session.get.return_value = fake_response
+        limited = controller.wrap('127.0.0.1', session)
+        assert limited.reserve() is True
+        assert controller.wrap('127.0.0.1', session).reserve() is False
+        assert controller.limit_for('127.0.0.1').in_flight == 1
+        limited.get('http://127.0.0.1/')
+        assert controller.limit_for('127.0.0.1').in_flight == 0
+
+    def test_hedger(self):
+        """
+        Verify slow requests are hedged within the budget.
+        """
+        hedger = hedging.Hedger(budget=0.5, min_delay=0.01, min_samples=2)
+        assert hedger.delay_for('127.0.0.1') is None
+        hedger.record('127.0.0.1', 0.01)
+        hedger.record('127.0.0.1', 0.02)
+        assert hedger.delay_for('127.0.0.1') == 0.02
+
+        fast_response = mock.MagicMock(status_code=200)
+        assert hedger.send('127.0.0.1', lambda a: fast_response) is (
+            fast_response)
+
+        responses = {1: mock.MagicMock(status_code=200),
+                     2: mock.MagicMock(status_code=200)}
+
+        def call(attempt):
+            if attempt == 1:
+                time.sleep(0.2)
+            return responses[attempt]
+
+        # One hedge in two requests is within budget and the hedge wins
+        assert hedger.send('127.0.0.1', call) is responses[2]
+        time.sleep(0.3)
+        responses[1].close.assert_called_once_with()
+        assert responses[2].close.call_count == 0
+
+        # Two hedges in three requests would go over budget
+        responses = {1: mock.MagicMock(status_code=200)}
+        assert hedger.send('127.0.0.1', call) is responses[1]
+        assert hedger.stats() == {
+            'hedge_requests': 3, 'hedges_sent': 1, 'hedge_wins': 1}
+
+        # When both attempts fail the first attempt's outcome is kept and
+        # no win is counted, whichever failed first
+        hedger.budget = 1.0
+        responses = {1: mock.MagicMock(status_code=503),
+                     2: mock.MagicMock(status_code=502)}
+        responses[2].close.side_effect = IOError
+
+        def failing_call(attempt):
+            if attempt == 1:
+                time.sleep(0.5)
+            return responses[attempt]
+        assert hedger.send('127.0.0.1', failing_call) is responses[1]
+        responses[2].close.assert_called_once_with()
+        assert hedger.stats()['hedge_wins'] == 1
+
+        # Without a free slot the request is not hedged and no budget
+        # is spent
+        responses = {1: mock.MagicMock(status_code=200)}
+        reserve = mock.MagicMock(return_value=False)
+        assert hedger.send('127.0.0.1', failing_call, reserve) is (
+            responses[1])
+        reserve.assert_called_once_with()
+        assert hedger.stats()['hedges_sent'] == 2
+
+    def test_request_get_hedged(self):
+        """
+        Verify request_get hedges when asked to.
+        """
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.httprequestworker.HTTPRequestWorker.notify'),
+                mock.patch('replugin.httprequestworker.HTTPRequestWorker.send'),
+                mock.patch('requests.Session.get')) as (_, _, _, _get):
+
+            slow_response = requests.Response()
+            slow_response.status_code = 200
+            slow_response._content_consumed = True
+            fast_response = requests.Response()
+            fast_response.status_code = 200
+            fast_response._content_consumed = True
+            calls = []
+
+            def get(*args, **kwargs):
+                calls.append(args)
+                if len(calls) == 1:
+                    time.sleep(0.2)
+                    return slow_response
+                return fast_response
+            _get.side_effect = get
+
+            worker = httprequestworker.HTTPRequestWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/example.json')
+            worker._hedging = hedging.Hedger(budget=1.0, min_samples=1)
+            worker._hedging.record('127.0.0.1', 0.01)
+
+            params = {'url': 'http://127.0.0.1', 'hedge': True}
+            assert worker._send('get', params) is fast_response
+            assert calls == [('http://127.0.0.1',), ('http://127.0.0.1',)]
+            assert worker.stats()['hedge_wins'] == 1
+
+            # No hedge is sent while the first request holds the only slot
+            del calls[:]
+            worker._concurrency.limit_for('127.0.0.1').limit = 1.0
+            assert worker._send('get', params) is slow_response
+            assert len(calls) == 1
+            assert worker.stats()['hedges_sent'] == 1
+            worker._concurrency.limit_for('127.0.0.1').limit = 4.0
+
+            # Without the parameter only one request is sent
+            del calls[:]
+            worker._send('get', {'url': 'http://127.0.0.1'})
+            time.sleep(0.3)
+            assert len(calls) == 1